@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import re
 
+import hackbin
+
 _dest_table = {
     None  : "000",
     "M"   : "001",
@@ -40,7 +42,14 @@ _comp_table = {
     "D-M" : "1010011",
     "M-D" : "1000111",
     "D&M" : "1000000",
-    "D|M" : "1010101"}
+    "D|M" : "1010101",
+    # commutative spellings, as emitted by the VM translator
+    "A+D" : "0000010",
+    "A&D" : "0000000",
+    "A|D" : "0010101",
+    "M+D" : "1000010",
+    "M&D" : "1000000",
+    "M|D" : "1010101"}
 
 _jump_table = {
     None : "000",
@@ -114,8 +123,8 @@ def _isC(line):
 def _processC(cExp):
     dest, comp, jump = cExp.group(1), cExp.group(2), cExp.group(3)
     return "111" + \
-           _dest_table[dest] + \
            _comp_table[comp] + \
+           _dest_table[dest] + \
            _jump_table[jump]
 
 def _build_sym_table(f, sym):
@@ -123,8 +132,8 @@ def _build_sym_table(f, sym):
     out_line_ct = 0
     for line in f:
         in_line_ct += 1
-        if not _isBlankLine(line):
-            out_line_ct += 1
+        if _isBlankLine(line):
+            continue
         m = _isLabel(line)
         if m:
             label = m.group(1)
@@ -132,7 +141,9 @@ def _build_sym_table(f, sym):
                 _die_with_err_msg(in_line_ct,
                                   "label %s already defined!" %
                                   line)
-            sym[label] = out_line_ct + 1
+            sym[label] = out_line_ct  # address of the next instruction
+        else:
+            out_line_ct += 1
     f.seek(0)
 
 def _assemble(f, sym):
@@ -160,40 +171,235 @@ def _assemble(f, sym):
                 _die_with_err_msg(linect,
                                   "invalid C expression!\n\t%s" %
                                   line)
-    return "\n".join(out)
+    return out
+
+def _assemble_regex(f, sym):
+    _build_sym_table(f, sym)
+    return _assemble(f, sym)
+
+# The table-driven engine classifies each distinct source line once, using
+# the same (precompiled) patterns as the regex engine, and keeps the result
+# in a table keyed by line text. Translated VM code repeats a small set of
+# lines ("@SP", "M=M+1", "A=M-1", ...) over and over, so nearly every line
+# after the first few thousand is a single dict lookup.
+_blank_re = re.compile(r'^\s*(?://.*)?$')
+_label_re = re.compile(r'^\s*\(([\w$._:][\w$._:\d]*)\)\s*(?://.*)?$')
+_a_re = re.compile(r'^\s*@([^\s]+)\s*(?://.*)?$')
+_c_re = re.compile(r'^(?:\s*(A?M?D?)\s*=)?\s*' +
+                   r'(0|1|-1|[!-]?[ADM]|(?:A|D|M)[\+\-&|](?:A|D|M|1))' +
+                   r'\s*(?:;\s*(JLT|JEQ|JGT|JLE|JGE|JNE|JMP))?' +
+                   r'\s*(?://.*)?$')
+
+# line kinds
+_BLANK, _LABEL, _WORD, _SYMBOL, _BAD_A, _BAD_C = range(6)
+
+def _toBinary(val):
+    return bin(int(val))[2:].zfill(16)  # decimal to binary
+
+def _classify(line):
+    """Returns a (kind, value) pair for a single line of source.
+    value is the label name for _LABEL, the encoded instruction for _WORD
+    and the symbol name for _SYMBOL."""
+    if _blank_re.match(line):
+        return _BLANK, None
+    m = _label_re.match(line)
+    if m:
+        return _LABEL, m.group(1)
+    m = _a_re.match(line)
+    if m:
+        val = m.group(1)
+        if not val.isnumeric():
+            return _SYMBOL, val
+        try:
+            return _WORD, _toBinary(val)
+        except ValueError:
+            return _BAD_A, None
+    m = _c_re.match(line)
+    try:
+        return _WORD, _processC(m)
+    except (AttributeError, KeyError):
+        return _BAD_C, None
+
+_mark = "// vm "  # source map mark, as written by the VM translator
+
+def _scan(f, sym, marks=None):
+    """First pass of the table engine: adds the labels in f to sym and returns
+    a (kind, value) pair for every instruction, in ROM order.
+    If marks is a list, an (address, text) pair is appended to it for every
+    source map mark, address being that of the next instruction."""
+    lines = {}      # line text -> (kind, value)
+    program = []    # (kind, value) for every instruction, in ROM order
+    error = None    # first bad instruction, reported once labels are in
+    in_line_ct = 0
+    for line in f:
+        in_line_ct += 1
+        entry = lines.get(line)
+        if entry is None:
+            entry = lines[line] = _classify(line)
+        kind = entry[0]
+        if kind == _BLANK:
+            if marks is not None and line.lstrip().startswith(_mark):
+                marks.append((len(program), line.strip()[len(_mark):]))
+            continue
+        if kind == _LABEL:
+            label = entry[1]
+            if label in sym:
+                _die_with_err_msg(in_line_ct,
+                                  "label %s already defined!" %
+                                  line)
+            sym[label] = len(program)
+            continue
+        if error is None and kind >= _BAD_A:
+            error = (in_line_ct, "invalid %s expression!\n\t%s" %
+                     ("A" if kind == _BAD_A else "C", line))
+        program.append(entry)
+    if error:
+        _die_with_err_msg(*error)
+    return program
+
+def _assemble_table(f, sym, marks=None):
+    program = _scan(f, sym, marks)
+    words = {}  # symbol -> encoded A instruction
+    newsymaddr = 16 # past R15, per specification
+    out = []
+    append = out.append
+    for kind, val in program:
+        if kind == _WORD:
+            append(val)
+            continue
+        word = words.get(val)
+        if word is None:
+            if val not in sym:
+                sym[val] = newsymaddr
+                newsymaddr += 1
+            word = words[val] = _toBinary(sym[val])
+        append(word)
+    return out
+
+_engines = {
+    "regex" : _assemble_regex,
+    "table" : _assemble_table}
+
+def assemble_stream(f, engine="table", marks=None):
+    """Assembles the text stream f (an open file, io.StringIO, ...) and
+    returns the list of instruction words as strings of binary digits.
+    The "regex" engine reads f twice, so needs f to be seekable.
+    If marks is a list, the source map marks in f are appended to it as
+    (address, text) pairs; only the "table" engine supports this."""
+    if marks is not None:
+        return _assemble_table(f, _default_symbols(), marks)
+    return _engines[engine](f, _default_symbols())
+
+def write_source_map(marks, outfile):
+    """Writes marks, as collected by assemble_stream, one per line: the
+    ROM address followed by the text of the mark (for code from the VM
+    translator: file, line, function and VM command)."""
+    with open(outfile, 'w') as f:
+        f.writelines("%d %s\n" % mark for mark in marks)
+
+def read_source_map(file):
+    """Returns the marks in a source map written by write_source_map."""
+    with open(file, 'r') as f:
+        return [(int(address), text) for address, text in
+                (line.rstrip("\n").split(" ", 1) for line in f)]
 
-def assemble(file, outfile=None, loghook=None):
+def assemble(file, outfile=None, loghook=None, engine="table", binary=False, source_map=False):
+    """Assembles file into outfile (file with a .hack extension by default).
+    engine selects the assembler implementation, one of "regex" or "table";
+    both produce identical output.
+    If binary is set, the output is instead written as packed 16-bit words
+    (see hackbin.py), to a file with a .hackbin extension by default.
+    If source_map is set, the source map marks in file are also written to
+    a file named as outfile, with a .hackmap extension (table engine only).
+    Errors in the source are passed to loghook and raised as RuntimeError."""
     if loghook:
         from time import time
         start = time()
     if outfile is None:
         import os
-        outfile = os.path.splitext(file)[0] + ".hack"
+        outfile = os.path.splitext(file)[0] + (".hackbin" if binary else ".hack")
+    marks = [] if source_map else None
     with open(file, 'r') as f:
         try:
             if loghook: loghook("opened %s" % file)
             sym = _default_symbols()
-            if loghook: loghook("loaded default symbols")
-            _build_sym_table(f, sym)
-            if loghook: loghook("built symbol table, now assembling")
-            out = _assemble(f, sym) # currently
+            if loghook: loghook("loaded default symbols, now assembling")
+            if source_map:
+                out = _assemble_table(f, sym, marks)
+            else:
+                out = _engines[engine](f, sym)
+            if binary: out = hackbin.pack(out)
         except RuntimeError as err:
             if loghook: loghook(err.args[0])
-            exit(-1)
+            raise
         if loghook: loghook("finished building, writing to %s" % outfile)
-    with open(outfile, 'w') as f:
-        f.write(out)
-    if loghook: total_time = (time() - start) / 1000
+    if binary:
+        hackbin.write_hackbin(out, outfile)
+    else:
+        with open(outfile, 'w') as f:
+            f.write("\n".join(out))
+    if source_map:
+        import os
+        write_source_map(marks, os.path.splitext(outfile)[0] + ".hackmap")
+    if loghook: total_time = time() - start
     if loghook: loghook("done with %s in %0.6fs" % (file, total_time))
 
-if __name__ == '__main__':
-    from sys import argv, stderr
-    from os.path import basename, splitext
-    if len(argv) < 2 or re.match(r'-h', argv[1]):
-        print("Usage: %s [file...]" %
-              splitext(basename(argv[0]))[0],
-              file=stderr)
-    else:
-        for file in argv[1:]:
-            assemble(file, loghook=lambda str: print(str, file=stderr))
+def _assemble_job(file, engine, binary, source_map):
+    """Assembles a single file for assemble_all, returning its log and its
+    error message (None on success) instead of writing to stderr."""
+    log = []
+    try:
+        assemble(file, loghook=log.append, engine=engine, binary=binary, source_map=source_map)
+    except RuntimeError as err:
+        return log, "%s: %s" % (file, err.args[0])
+    except OSError as err:
+        # the failing file may be the output, so the error names it
+        return log, "%s: %s" % (err.filename or file, err.strerror or err)
+    return log, None
+
+def assemble_all(files, jobs=1, loghook=None, engine="table", binary=False, source_map=False):
+    """Assembles each of files, in a pool of jobs worker processes if jobs > 1.
+    A failing file does not stop the batch. Log output for each file is
+    passed to loghook in the order files were given, and the list of error
+    messages for files that failed is returned."""
+    args = [(file, engine, binary, source_map) for file in files]
+    if jobs > 1 and len(files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(_assemble_job, *zip(*args))
+            return _collect(results, loghook)
+    return _collect((_assemble_job(*job) for job in args), loghook)
+
+def _collect(results, loghook):
+    errors = []
+    for log, err in results:
+        if loghook:
+            for line in log: loghook(line)
+        if err: errors.append(err)
+    return errors
+
+def main():
+    import os
+    import argparse
+    from sys import stderr
+    parser = argparse.ArgumentParser(description='Assembles Hack assembly into machine code')
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-b", help="Write packed binary (.hackbin) output", action="store_true")
+    parser.add_argument("-e", help="Assembler engine to use", choices=_engines, default="table")
+    parser.add_argument("-m", help="Write the source map marks to a .hackmap file", action="store_true")
+    parser.add_argument("-j", help="Assemble files in N parallel processes (0: one per core; default: 1)",
+                        metavar="N", type=int, default=1)
+    args = parser.parse_args()
+    jobs = args.j if args.j > 0 else os.cpu_count() or 1
+    errors = assemble_all(args.files, jobs,
+                          loghook=lambda str: print(str, file=stderr),
+                          engine=args.e, binary=args.b, source_map=args.m)
+    if errors:
+        print("%d of %d files failed:" % (len(errors), len(args.files)), file=stderr)
+        for err in errors:
+            print(err, file=stderr)
+        exit(1)
     exit(0)
+
+if __name__ == '__main__':
+    main()
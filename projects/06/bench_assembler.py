@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# benchmarks the assembler engines against each other on generated programs
+import io
+import random
+import argparse
+from time import perf_counter
+
+import assembler_regex
+
+
+# snippets shaped like the output of the VM translator
+_snippets = [
+    ["@SP", "M=M+1", "A=M-1", "M=D"],
+    ["@SP", "M=M-1", "A=M", "D=M"],
+    ["@LCL", "D=M", "@{n}", "A=D+A", "D=M"],
+    ["@ARG", "D=M", "@{n}", "D=D+A", "@R13", "M=D"],
+    ["@SP", "A=M-1", "M=M+D"],
+    ["@SP", "A=M-1", "M=!M"],
+    ["@{n}", "D=A"],
+    ["@{var}", "D=M", "@{var}", "M=D"],
+    ["   D=M-D   // compare", "@{label}", "D;JEQ"],
+    ["@{label}", "0;JMP"],
+    ["", "// comment line"],
+]
+
+
+def generate(lines, seed=0):
+    """Returns the text of a synthetic program of at least the given number of lines."""
+    rng = random.Random(seed)
+    out = []
+    labels = 0
+    while len(out) < lines:
+        if rng.random() < 0.05:
+            out.append("(L%d)" % labels)
+            labels += 1
+            continue
+        for line in rng.choice(_snippets):
+            out.append(line.format(n=rng.randrange(32768),
+                                   var="v%d" % rng.randrange(200),
+                                   label="L%d" % rng.randrange(labels + 1)))
+    out.append("(L%d)" % labels)  # every jump target is defined
+    return "\n".join(out) + "\n"
+
+
+def run(engine, source, repeat):
+    best = None
+    for _ in range(repeat):
+        f = io.StringIO(source)
+        start = perf_counter()
+        out = assembler_regex._engines[engine](f, assembler_regex._default_symbols())
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares assembler engines on generated input')
+    parser.add_argument("-n", help="lines per generated program", type=int,
+                        action="append", default=None)
+    parser.add_argument("-r", help="runs per engine (best is reported)", type=int, default=3)
+    args = parser.parse_args()
+    for lines in args.n or [100000, 500000]:
+        source = generate(lines)
+        results = {engine: run(engine, source, args.r)
+                   for engine in assembler_regex._engines}
+        outputs = {tuple(out) for out, _ in results.values()}
+        if len(outputs) != 1:
+            raise SystemExit("engines disagree on %d line input!" % lines)
+        base = results["regex"][1]
+        for engine, (_, elapsed) in results.items():
+            print("%8d lines  %-6s %8.3fs  %9.0f lines/s  x%.1f" %
+                  (lines, engine, elapsed, lines / elapsed, base / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# benchmarks the Hack emulator engines, and a decode-every-cycle interpreter
+import io
+import argparse
+from array import array
+from time import perf_counter
+
+import assembler_regex
+import hack_machine
+
+
+# multiplies R0 by R1 into R2 by repeated addition, 100 times over
+_MULT = """
+    @100
+    D=A
+    @R3
+    M=D
+(OUTER)
+    @R2
+    M=0
+    @R1
+    D=M
+    @R4
+    M=D
+(LOOP)
+    @R4
+    D=M
+    @NEXT
+    D;JEQ
+    @R0
+    D=M
+    @R2
+    M=D+M
+    @R4
+    M=M-1
+    @LOOP
+    0;JMP
+(NEXT)
+    @R3
+    MD=M-1
+    @OUTER
+    D;JGT
+(END)
+    @END
+    0;JMP
+"""
+
+# fills the screen with black, 10 times over, walking a pointer through it
+_FILL = """
+    @10
+    D=A
+    @count
+    M=D
+(FRAME)
+    @SCREEN
+    D=A
+    @addr
+    M=D
+(LOOP)
+    @addr
+    A=M
+    M=-1
+    @addr
+    MD=M+1
+    @KBD
+    D=D-A
+    @LOOP
+    D;JLT
+    @count
+    MD=M-1
+    @FRAME
+    D;JGT
+(END)
+    @END
+    0;JMP
+"""
+
+# name -> (source, initial RAM values)
+_programs = {
+    "mult": (_MULT, {0: 123, 1: 2000}),
+    "fill": (_FILL, {}),
+}
+
+
+def _run_naive(rom, ram, cycles):
+    """Decodes every instruction's bits as it is executed, as a hardware
+    simulator does; the baseline for the predecoding emulator."""
+    a = d = pc = n = 0
+    while n < cycles and pc < len(rom):
+        i = rom[pc]
+        n += 1
+        if not i & 0x8000:
+            a = i
+            pc += 1
+            continue
+        y = ram[a] if i & 0x1000 else a
+        x = d
+        c = (i >> 6) & 0x3f
+        if c & 0x20: x = 0
+        if c & 0x10: x = ~x & 0xffff
+        if c & 0x08: y = 0
+        if c & 0x04: y = ~y & 0xffff
+        o = (x + y) & 0xffff if c & 0x02 else x & y
+        if c & 0x01: o = ~o & 0xffff
+        target = a
+        if i & 0x08: ram[a] = o
+        if i & 0x20: a = o
+        if i & 0x10: d = o
+        j = i & 7
+        if (j & 4 and o & 0x8000) or (j & 2 and o == 0) or (j & 1 and 0 < o < 0x8000):
+            pc = target
+        else:
+            pc += 1
+    return n
+
+
+def _time(words, inputs, engine, repeat, cycles=None):
+    best = None
+    for _ in range(repeat):
+        machine = hack_machine.HackMachine(words)
+        for address, value in inputs.items():
+            machine.ram[address] = value
+        start = perf_counter()
+        if engine == "naive":
+            ram = machine.ram.tolist()
+            machine.cycles = _run_naive(machine.rom, ram, cycles)
+            machine.ram[:] = array('H', ram)
+        else:
+            machine.run(engine=engine)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return machine, best
+
+
+def run(source, inputs, repeat):
+    """Returns the instruction count of the program and the best time of
+    each engine, checking that all of them end in the same state. Blocks
+    are compiled on the first run only, and reused by later ones."""
+    words = [int(word, 2) for word in assembler_regex.assemble_stream(io.StringIO(source))]
+    times = {}
+    machine, times["step"] = _time(words, inputs, "step", repeat)
+    cycles, ram = machine.cycles, machine.ram
+    for engine in ["naive", "blocks"]:
+        machine, times[engine] = _time(words, inputs, engine, repeat, cycles)
+        if machine.cycles != cycles or machine.ram != ram:
+            raise SystemExit("%s engine disagrees!" % engine)
+    return cycles, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the Hack emulator engines')
+    parser.add_argument("-r", help="runs per program (best is reported)", type=int, default=3)
+    args = parser.parse_args()
+    for name, (source, inputs) in _programs.items():
+        cycles, times = run(source, inputs, args.r)
+        for engine, elapsed in times.items():
+            print("%-5s %9d instructions  %-6s %7.3fs %10.0f/s  x%.1f" %
+                  (name, cycles, engine, elapsed, cycles / elapsed, times["step"] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# emulates the Hack computer: runs .hack, .hackbin or .asm programs
+#
+# Each ROM word is decoded once, when the program is loaded, into either
+# an int (an A-instruction's value) or a (comp, dest, jump) triple for a
+# C-instruction. comp is a function of A, D and RAM, compiled from the
+# mnemonic the assembler's _comp_table gives for its bits, so the decoder
+# and the assembler can never disagree on what an instruction means.
+#
+# The "step" engine dispatches on one decoded instruction at a time. The
+# "blocks" engine instead compiles each block -- the instructions from an
+# entry point up to the next conditional or computed jump, following
+# jumps to constant addresses -- into a single Python function, the first
+# time it is entered. Within a block the value of A is tracked at compile
+# time wherever an A-instruction set it, so "@SP, M=M+1" becomes
+# "ram[0] = (ram[0]+1) & 0xffff", values used once are substituted into
+# their use, and a block that jumps back to its own start loops in place.
+# Compiled blocks are kept per program (ROM contents), and shared by every
+# machine running it. Both engines end in the same state, except that
+# the blocks engine skips reads whose value is never used, and so does
+# not report those that are out of range.
+import os
+import re
+from array import array
+from collections import OrderedDict
+
+import hackbin
+import assembler_regex as asm
+
+RAM_SIZE = 32768
+SCREEN = 16384
+KBD = 24576
+
+# dest bits
+_M, _D, _A = 1, 2, 4
+
+# jump conditions on the (16 bit) ALU output, as source for compiled blocks
+_jump_exprs = {
+    "JGT": "0 < o < 0x8000",
+    "JEQ": "o == 0",
+    "JGE": "o < 0x8000",
+    "JLT": "o >= 0x8000",
+    "JNE": "o != 0",
+    "JLE": "o == 0 or o >= 0x8000"}
+
+# jump conditions on the (16 bit) ALU output
+_jumps = {
+    "JGT": lambda o: 0 < o < 0x8000,
+    "JEQ": lambda o: o == 0,
+    "JGE": lambda o: o < 0x8000,
+    "JLT": lambda o: o >= 0x8000,
+    "JNE": lambda o: o != 0,
+    "JLE": lambda o: o == 0 or o >= 0x8000,
+    "JMP": None}  # always, checked for separately
+
+
+def _comp_expr(mnemonic, a="a"):
+    """Returns a Python expression computing mnemonic (e.g. "D+M") from d,
+    ram and the expression a for the A register."""
+    expr = mnemonic.replace("M", "ram[A]").replace("A", a).replace("D", "d")
+    if expr in ("0", "1", "d", a, "ram[%s]" % a) or "&" in expr or "|" in expr:
+        return expr  # already 16 bits
+    return "(%s) & 0xffff" % expr.replace("!", "~")
+
+
+def _compile_comp(mnemonic):
+    """Returns a function of (a, d, ram) computing mnemonic."""
+    return eval("lambda a, d, ram: " + _comp_expr(mnemonic))
+
+
+def _tables():
+    comps = {}
+    mnemonics = {}
+    for mnemonic, bits in asm._comp_table.items():
+        mnemonics.setdefault(int(bits, 2), mnemonic)
+        comps.setdefault(int(bits, 2), _compile_comp(mnemonic))
+    dests = {int(bits, 2): sum(bit for name, bit in (("M", _M), ("D", _D), ("A", _A))
+                               if name in (mnemonic or ""))
+             for mnemonic, bits in asm._dest_table.items()}
+    jumps = {int(bits, 2): mnemonic for mnemonic, bits in asm._jump_table.items()}
+    return comps, mnemonics, dests, jumps
+
+_comps, _comp_names, _dests, _jump_names = _tables()
+
+
+def decode(word, address=0):
+    """Returns the decoded form of the instruction word: its value for an
+    A-instruction, or a (comp, dest, jump) triple for a C-instruction, where
+    jump is None for no jump, True for an unconditional jump and a test of
+    the ALU output otherwise."""
+    if not word & 0x8000:
+        return word
+    comp = _comps.get((word >> 6) & 0x7f)
+    if comp is None:
+        raise RuntimeError("ROM[%d]:\n\tinvalid instruction %s" %
+                           (address, bin(word)[2:].zfill(16)))
+    jump = _jump_names[word & 7]
+    jump = None if jump is None else _jumps[jump] or True
+    return comp, _dests[(word >> 3) & 7], jump
+
+
+def load(file):
+    """Returns (words, symbols) for a .hack, .hackbin or .asm file. symbols
+    maps label and variable names to addresses, and is only known for .asm."""
+    ext = os.path.splitext(file)[1]
+    if ext == ".hackbin":
+        return hackbin.load_hackbin(file), {}
+    with open(file, 'r') as f:
+        if ext == ".asm":
+            sym = asm._default_symbols()
+            words = asm._assemble_table(f, sym)
+            return [int(word, 2) for word in words], sym
+        return [int(word, 2) for word in f.read().split()], {}
+
+
+# (ROM contents, stop addresses) -> {entry: compiled block}, for the few
+# programs run last, so machines running the same program share blocks
+# without every program a long-running process ever ran staying in memory
+_block_cache = OrderedDict()
+_BLOCK_CACHE_SIZE = 4
+
+
+_register_re = re.compile(r"\b[adot]\b")  # registers and temporaries in block code
+
+
+def _reads(statement):
+    target, index, expr = statement
+    return _register_re.findall(expr + " " + (index or ""))
+
+
+def _simplify(body):
+    """Shortens the statements of a block, each a (target, index, expr)
+    triple for "target = expr" or "ram[index] = expr", by substituting
+    values that are used only once into their use, then dropping
+    assignments to registers that are overwritten before they are read.
+    The final statement is the block's return: ("return", "<a>, d", pc),
+    where the registers are never substituted, so that a block that loops
+    has them in place for the next pass."""
+    i = 0
+    while i < len(body) - 1:
+        target, _, expr = body[i]
+        if target in ("ram", "return"):
+            i += 1
+            continue
+        uses = []
+        for j in range(i + 1, len(body)):
+            uses.extend([j] * _reads(body[j]).count(target))
+            if body[j][0] == target:
+                break
+        if (len(uses) == 1 and _unchanged(body[i + 1:uses[0]], expr) and
+                not (body[uses[0]][0] == "return" and target in ("a", "d"))):
+            j = uses[0]
+            value = "(%s)" % expr
+            other, index, used = body[j]
+            if index is not None:
+                index = _register_re.sub(lambda m: value if m.group() == target else m.group(), index)
+            used = _register_re.sub(lambda m: value if m.group() == target else m.group(), used)
+            body[j] = (other, index, used)
+            del body[i]
+            i = max(i - 1, 0)  # the statement before may now be used once
+            continue
+        i += 1
+
+    live = {"a", "d"}
+    out = []
+    for statement in reversed(body):
+        target = statement[0]
+        if target not in ("ram", "return"):
+            if target not in live:
+                continue
+            live.discard(target)
+        live.update(_reads(statement))
+        out.append(statement)
+    out.reverse()
+    return out
+
+
+def _unchanged(statements, expr):
+    """Returns whether expr evaluates the same before and after statements."""
+    registers = set(_register_re.findall(expr))
+    memory = "ram[" in expr
+    return not any(target in registers or (memory and target == "ram")
+                   for target, _, _ in statements)
+
+
+_MAX_TRACE = 2000  # instructions in a block, when following jumps
+
+
+def _compile_block(rom, start, stops=frozenset()):
+    """Compiles the block entered at ROM address start into a Python
+    function of (a, d, ram, budget) that returns (a, d, pc, passes) after
+    the block. The block runs up to a conditional jump (or a jump to an
+    address not known in advance), following unconditional jumps to known
+    addresses; if it may jump back to its own start, it is run again in
+    place, up to budget passes (-1 for no limit).
+    Returns (function, length, halts, trace), where length is the number
+    of instructions in a pass, halts is set for the usual
+    "(END) @END 0;JMP" loop, and trace lists the addresses executed in a
+    pass, in order. Blocks also end before any of the addresses in stops."""
+    body = []
+    a = None  # A's value, if set by an A-instruction in this block
+    jump = None
+    pc = start
+    end = len(rom)
+    length = 0
+    trace = []
+    entries = {start}
+    while True:
+        length += 1
+        trace.append(pc)
+        word = rom[pc]
+        pc += 1
+        if not word & 0x8000:
+            a = word
+            if pc == end or pc in stops:
+                break
+            continue
+        comp = _comp_names.get((word >> 6) & 0x7f)
+        if comp is None:
+            raise RuntimeError("ROM[%d]:\n\tinvalid instruction %s" %
+                               (pc - 1, bin(word)[2:].zfill(16)))
+        reg = "a" if a is None else str(a)
+        value = _comp_expr(comp, reg)
+        dest = _dests[(word >> 3) & 7]
+        jump = _jump_names[word & 7]
+        target = reg
+        if jump or dest not in (0, _M, _D, _A):
+            body.append(("o", None, value))
+            value = "o"
+        if jump and dest & _A and a is None:
+            body.append(("t", None, "a"))
+            target = "t"
+        if dest & _M: body.append(("ram", reg, value))
+        if dest & _D: body.append(("d", None, value))
+        if dest & _A:
+            body.append(("a", None, value))
+            a = None
+        if jump:
+            halts = (jump == "JMP" and not dest and target == str(pc - 2) and
+                     rom[pc - 2] == pc - 2)
+            if (jump == "JMP" and target.isdigit() and not halts and
+                    length < _MAX_TRACE and int(target) not in entries and
+                    int(target) < end and int(target) not in stops):
+                # carry on at the (known) target, as part of this block
+                pc = int(target)
+                entries.add(pc)
+                jump = None
+                continue
+            if jump == "JMP":
+                next = target
+            else:
+                next = "%s if %s else %d" % (target, _jump_exprs[jump], pc)
+            break
+        if pc == end or pc in stops:
+            break
+    if not jump:
+        next, halts = str(pc), False
+    # a block whose next pass may be itself loops in place, up to budget times
+    loops = not halts and str(start) in next.split()
+    if loops and a is not None:
+        body.append(("a", None, str(a)))
+        a = None
+    body.append(("return", "%s, d" % ("a" if a is None else a), next))
+    lines = []
+    cached = set()  # constant addresses whose value is in a local, m<address>
+    for target, index, expr in _simplify(body):
+        for address in cached:
+            expr = expr.replace("ram[%d]" % address, "m%d" % address)
+            if index is not None:
+                index = index.replace("ram[%d]" % address, "m%d" % address)
+        if target == "ram":
+            if index.isdigit():
+                lines.append("m%s = ram[%s] = %s" % (index, index, expr))
+                cached.add(int(index))
+            else:
+                lines.append("ram[%s] = %s" % (index, expr))
+                cached.clear()  # may have written any of them
+        elif target == "return" and loops:
+            lines.extend(["pc = " + expr,
+                          "passes += 1",
+                          "if pc != %d or passes == budget:" % start,
+                          "    return %s, pc, passes" % index])
+        elif target == "return":
+            lines.append("return %s, %s, 1" % (index, expr))
+        else:
+            lines.append("%s = %s" % (target, expr))
+    if loops:
+        lines = ["passes = 0", "while True:"] + ["    " + line for line in lines]
+    source = "def block(a, d, ram, budget):\n    " + "\n    ".join(lines)
+    namespace = {}
+    exec(compile(source, "<ROM[%d]>" % start, "exec"), namespace)
+    return namespace["block"], length, halts, trace
+
+
+class HackMachine():
+    def __init__(self, rom):
+        """rom is a sequence of instruction words (ints, or strings of
+        binary digits as in .hack files), decoded here once and for all."""
+        self.rom = hackbin.pack(rom)
+        self.code = [decode(word, address) for address, word in enumerate(self.rom)]
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.reset()
+
+
+    def reset(self):
+        """Clears the registers and cycle count, as the reset button does.
+        RAM is left as is."""
+        self.a = self.d = self.pc = 0
+        self.cycles = 0
+
+
+    def set_key(self, code):
+        """Presses the key with the given Hack character code (0 for none)."""
+        self.ram[KBD] = code
+
+
+    def screen(self):
+        """Returns the 8K words of screen memory, 32 per row of pixels."""
+        return self.ram[SCREEN:KBD]
+
+
+    def run(self, cycles=None, until=None, engine="blocks"):
+        """Runs until cycles instructions have been executed, the program
+        counter reaches the address until or leaves ROM, or the program
+        enters the usual "(END) @END 0;JMP" loop. Returns the number of
+        instructions executed; the total is kept in self.cycles.
+        engine is one of "blocks" or "step"; both stop in the same state."""
+        return _engines[engine](self, cycles, until)
+
+
+    def _run_blocks(self, cycles, until):
+        key = (self.rom.tobytes(), until)
+        blocks = _block_cache.get(key)
+        if blocks is None:
+            blocks = _block_cache[key] = {}
+            if len(_block_cache) > _BLOCK_CACHE_SIZE:
+                _block_cache.popitem(last=False)
+        else:
+            _block_cache.move_to_end(key)
+        get = blocks.get
+        rom = self.rom
+        ram = self.ram.tolist()  # list items are quicker to get and set
+        a, d, pc = self.a, self.d, self.pc
+        end = len(rom)
+        stop = -1 if until is None else until
+        stops = frozenset() if until is None else frozenset([until])
+        n = 0
+        entry = pc
+        remaining = 0
+        try:
+            while pc < end and pc != stop:
+                block = get(pc)
+                if block is None:
+                    block = blocks[pc] = _compile_block(rom, pc, stops)
+                function, length, halts, trace = block
+                if cycles is None:
+                    budget = -1
+                else:
+                    budget = (cycles - n) // length
+                    if budget == 0:
+                        remaining = cycles - n  # stepped through below
+                        break
+                entry = pc
+                a, d, pc, passes = function(a, d, ram, budget)
+                n += passes * length
+                if halts:
+                    break
+        except IndexError:
+            raise RuntimeError("ROM[%d]:\n\tRAM address out of range in block" % entry)
+        finally:
+            self.ram[:] = array('H', ram)
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += n
+        if remaining:
+            n += self._run_step(remaining, until)
+        return n
+
+
+    def _run_step(self, cycles, until):
+        code = self.code
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        limit = -1 if cycles is None else cycles
+        end = len(code)
+        stop = -1 if until is None else until
+        n = 0
+        try:
+            while n != limit and pc < end and pc != stop:
+                op = code[pc]
+                n += 1
+                if op.__class__ is int:
+                    a = op
+                    pc += 1
+                    continue
+                comp, dest, jump = op
+                o = comp(a, d, ram)
+                if jump is None:
+                    pc += 1
+                elif jump is True or jump(o):
+                    if jump is True and a == pc - 1 and code[a] == a and not dest:
+                        pc = a
+                        break  # jumps back to itself forever
+                    target = a
+                else:
+                    target = pc + 1
+                if dest:
+                    if dest & _M: ram[a] = o
+                    if dest & _D: d = o
+                    if dest & _A: a = o
+                if jump is not None:
+                    pc = target
+        except IndexError:
+            raise RuntimeError("ROM[%d]:\n\tRAM address %d out of range" % (pc, a))
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += n
+        return n
+
+
+_engines = {
+    "blocks": HackMachine._run_blocks,
+    "step": HackMachine._run_step}
+
+
+def main():
+    import sys
+    import argparse
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description='Runs a Hack program')
+    parser.add_argument("file", help=".hack, .hackbin or .asm program")
+    parser.add_argument("-n", help="Stop after N instructions", metavar="N", type=int)
+    parser.add_argument("-u", help="Stop at this ROM address (or label, for .asm)", metavar="ADDR")
+    parser.add_argument("-d", help="Print RAM[START..END) when done", metavar="START:END")
+    parser.add_argument("-e", help="Execution engine to use", choices=_engines, default="blocks")
+    args = parser.parse_args()
+    try:
+        words, sym = load(args.file)
+        until = None
+        if args.u is not None:
+            until = int(args.u) if args.u.isdigit() else sym[args.u]
+        machine = HackMachine(words)
+        start = perf_counter()
+        machine.run(args.n, until, args.e)
+        elapsed = perf_counter() - start
+    except KeyError as err:
+        print("unknown label %s" % err.args[0], file=sys.stderr)
+        exit(1)
+    except RuntimeError as err:
+        print(err.args[0], file=sys.stderr)
+        exit(1)
+    print("%d instructions in %0.3fs (%0.0f/s), stopped at ROM[%d]" %
+          (machine.cycles, elapsed, machine.cycles / max(elapsed, 1e-9), machine.pc),
+          file=sys.stderr)
+    if args.d:
+        first, last = (int(x) for x in args.d.split(":"))
+        for address in range(first, last):
+            print("RAM[%d] = %d" % (address, machine.ram[address]))
+    exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# packed binary ROM images (.hackbin): one little-endian 16-bit word per instruction
+import sys
+import mmap
+from array import array
+
+
+def pack(words):
+    """Packs an iterable of instruction words (ints, or strings of binary
+    digits as written to .hack files) into an array('H') of native words."""
+    words = list(words)
+    if words and isinstance(words[0], str):
+        words = [int(word, 2) for word in words]
+    try:
+        return array('H', words)
+    except OverflowError:
+        bad = next(i for i, word in enumerate(words) if not 0 <= word < 65536)
+        raise RuntimeError("Instruction %d:\n\t%d does not fit in 16 bits" %
+                           (bad, words[bad]))
+
+
+def write_hackbin(words, file):
+    """Writes instruction words to file as packed little-endian 16-bit words."""
+    rom = words if isinstance(words, array) else pack(words)
+    if sys.byteorder == 'big':
+        rom = array('H', rom)
+        rom.byteswap()
+    with open(file, 'wb') as f:
+        rom.tofile(f)
+
+
+def load_hackbin(file):
+    """Returns the words of a .hackbin file as a read-only memoryview of
+    unsigned 16-bit ints, indexed by ROM address.
+
+    The view is backed directly by a memory map of the file, so no parsing
+    or copying happens up front; pages are read in as they are touched.
+    On big-endian hosts (and for empty files, which cannot be mapped) the
+    words are read into memory instead."""
+    with open(file, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        if size % 2:
+            raise RuntimeError("%s: truncated ROM image (%d bytes)" % (file, size))
+        if size == 0 or sys.byteorder == 'big':
+            f.seek(0)
+            rom = array('H')
+            rom.frombytes(f.read())
+            if sys.byteorder == 'big':
+                rom.byteswap()
+            return memoryview(rom).toreadonly()
+        rom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(rom).cast('H')
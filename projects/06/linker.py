@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# separate assembly of .asm units into relocatable objects, and linking them
+#
+# An object (.hackobj, JSON) holds one unit's machine code with every
+# address that is not known until link time left open:
+#   code    - instruction words; open slots hold the unit-relative value
+#             (local labels) or 0 (symbol references)
+#   relocs  - code offsets of local label references, rebased at link time
+#   labels  - labels defined in the unit, relative to its first instruction
+#   symbols - every other symbol the unit references, in order of first use;
+#             each is either a label of another unit or a variable
+#   refs    - [code offset, index into symbols] for each such reference
+#
+# Hack assembly has no scoping, so the linker gives exactly the output the
+# assembler would for the concatenation of all units: labels are global,
+# and variables get RAM slots from 16 up in order of first use.
+import io
+import os
+import json
+import hashlib
+
+import hackbin
+import assembler_regex as asm
+
+OBJECT_VERSION = 1
+
+
+def _source_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _build_object(f, source):
+    sym = asm._default_symbols()
+    program = asm._scan(f, sym)
+    defaults = asm._default_symbols()
+    labels = {name: addr for name, addr in sym.items() if name not in defaults}
+
+    code, relocs, symbols, refs = [], [], [], []
+    index = {}  # symbol -> position in symbols
+    for kind, val in program:
+        if kind == asm._WORD:
+            code.append(int(val, 2))
+        elif val in defaults:
+            code.append(defaults[val])
+        elif val in labels:
+            relocs.append(len(code))
+            code.append(labels[val])
+        else:
+            if val not in index:
+                index[val] = len(symbols)
+                symbols.append(val)
+            refs.append([len(code), index[val]])
+            code.append(0)
+    return {
+        "version": OBJECT_VERSION,
+        "source": source,
+        "code": code,
+        "relocs": relocs,
+        "labels": labels,
+        "symbols": symbols,
+        "refs": refs}
+
+
+def assemble_object(file, outfile=None, loghook=None):
+    """Assembles file into a relocatable object, written to outfile
+    (file with a .hackobj extension by default). Returns the object."""
+    if outfile is None:
+        outfile = os.path.splitext(file)[0] + ".hackobj"
+    with open(file, 'rb') as f:
+        data = f.read()
+    if loghook: loghook("assembling %s" % file)
+    try:
+        obj = _build_object(io.TextIOWrapper(io.BytesIO(data)), _source_hash(data))
+    except RuntimeError as err:
+        raise RuntimeError("%s: %s" % (file, err.args[0]))
+    with open(outfile, 'w') as f:
+        json.dump(obj, f, separators=(",", ":"))
+    return obj
+
+
+def load_object(file, loghook=None):
+    """Returns the object for file. A .hackobj file is loaded as is; for
+    an .asm file, the object next to it is reused if it was built from the
+    same source by the same object version, and rebuilt otherwise."""
+    base, ext = os.path.splitext(file)
+    if ext == ".hackobj":
+        with open(file, 'r') as f:
+            return json.load(f)
+    objfile = base + ".hackobj"
+    try:
+        with open(objfile, 'r') as f:
+            obj = json.load(f)
+        with open(file, 'rb') as f:
+            source = _source_hash(f.read())
+        if obj.get("version") == OBJECT_VERSION and obj.get("source") == source:
+            if loghook: loghook("reusing %s" % objfile)
+            return obj
+    except (OSError, ValueError):
+        pass
+    return assemble_object(file, objfile, loghook)
+
+
+def link(objects, names=None):
+    """Links objects, in order, into a single program and returns its
+    instruction words. names (the units' file names) are used in errors."""
+    if names is None:
+        names = ["unit %d" % i for i in range(len(objects))]
+    labels = {}
+    owner = {}
+    bases = []
+    base = 0
+    for obj, name in zip(objects, names):
+        bases.append(base)
+        for label, addr in obj["labels"].items():
+            if label in labels:
+                raise RuntimeError("%s:\n\tlabel %s already defined in %s!" %
+                                   (name, label, owner[label]))
+            labels[label] = base + addr
+            owner[label] = name
+        base += len(obj["code"])
+
+    out = []
+    variables = {}
+    newsymaddr = 16 # past R15, per specification
+    for obj, base in zip(objects, bases):
+        code = list(obj["code"])
+        for pc in obj["relocs"]:
+            code[pc] += base
+        symbols = obj["symbols"]
+        for pc, i in obj["refs"]:
+            val = symbols[i]
+            if val in labels:
+                code[pc] = labels[val]
+            else:
+                if val not in variables:
+                    variables[val] = newsymaddr
+                    newsymaddr += 1
+                code[pc] = variables[val]
+        out.extend(code)
+    return out
+
+
+def link_files(files, outfile, loghook=None, binary=False):
+    """Links .asm and .hackobj files, in order, into outfile (.hack text, or
+    packed .hackbin if binary is set). .asm units are only reassembled when
+    their source has changed since their object was built."""
+    objects = [load_object(file, loghook) for file in files]
+    words = link(objects, files)
+    if loghook: loghook("linked %d units (%d words), writing to %s" %
+                        (len(files), len(words), outfile))
+    if binary:
+        hackbin.write_hackbin(words, outfile)
+    else:
+        with open(outfile, 'w') as f:
+            f.write("\n".join(bin(word)[2:].zfill(16) for word in words))
+
+
+def main():
+    import argparse
+    from sys import stderr
+    parser = argparse.ArgumentParser(description='Links separately assembled Hack units')
+    parser.add_argument("files", nargs="+", help=".asm or .hackobj units, in ROM order")
+    parser.add_argument("-o", help="Output file (default: first unit with a .hack/.hackbin extension)")
+    parser.add_argument("-b", help="Write packed binary (.hackbin) output", action="store_true")
+    args = parser.parse_args()
+    outfile = args.o or os.path.splitext(args.files[0])[0] + (".hackbin" if args.b else ".hack")
+    try:
+        link_files(args.files, outfile, lambda str: print(str, file=stderr), args.b)
+    except RuntimeError as err:
+        print(err.args[0], file=stderr)
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# benchmarks the VM translator on large generated programs
+import io
+import os
+import re
+import sys
+import random
+import argparse
+import tempfile
+from time import perf_counter
+
+import vm_compiler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+import assembler_regex
+
+
+_segments = ["local", "argument", "this", "that", "temp", "static"]
+_arith = ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]
+
+
+def generate(commands, seed=0):
+    """Returns the text of a synthetic VM file of about the given number of
+    commands, in the shape the Jack compiler emits."""
+    rng = random.Random(seed)
+    out = []
+    functions = 0
+    while len(out) < commands:
+        out.append("function Gen.f%d %d" % (functions, rng.randrange(4)))
+        for label in range(rng.randrange(20, 200)):
+            r = rng.random()
+            if r < 0.35:
+                out.append("push %s %d" % (rng.choice(_segments), rng.randrange(8)))
+            elif r < 0.5:
+                out.append("push constant %d" % rng.randrange(32768))
+            elif r < 0.65:
+                out.append("pop %s %d" % (rng.choice(_segments), rng.randrange(8)))
+            elif r < 0.8:
+                out.append(rng.choice(_arith))
+            elif r < 0.85:
+                out.append("label L%d" % label)
+                out.append("if-goto L%d" % label)
+            elif r < 0.88:
+                out.append("goto L%d" % label)
+                out.append("label L%d" % label)
+            else:
+                out.append("call Gen.f%d %d" % (rng.randrange(functions + 1), rng.randrange(4)))
+        out.append("return")
+        functions += 1
+    return "\n".join(out) + "\n"
+
+
+class LegacyParser(vm_compiler.Parser):
+    """The regex-per-query parser the translator used before parsing each
+    line once into Commands; kept here as the benchmark baseline."""
+    def __init__(self, file):
+        with open(file, 'r') as f:
+            lines = f.readlines()
+        lines = map(self._cleanLine, lines)
+        self.lines = list(filter(None, lines))
+        self.current_line = 0
+        self.dict = {
+            "C_ARITHMETIC": r"(add|and|neg|not|or|sub|eq|gt|lt)",
+            "C_LABEL": r"label ([\w_.][\d\w_.]*)",
+            "C_GOTO": r"goto ([\w_.][\d\w_.]*)",
+            "C_IF": r"if-goto ([\w_.][\d\w_.]*)",
+            "C_PUSH": r"push (local|argument|this|that|temp|pointer|static|constant) (\d+)",
+            "C_POP": r"pop (local|argument|this|that|temp|pointer|static|constant) (\d+)",
+            "C_FUNCTION": r"function ([\w_.][\d\w_.]*) (\d+)",
+            "C_CALL": r"call ([\w_.][\d\w_.]*) (\d+)",
+            "C_RETURN": r"return"
+        }
+
+    @staticmethod
+    def _cleanLine(line):
+        line = re.sub(r'^\s*', '', line)
+        line = re.sub(r'\s\s*', ' ', line)
+        line = re.sub(r'//.*$', '', line)
+        return line
+
+    def hasMoreCommands(self):
+        return self.current_line < len(self.lines)
+
+    def commandType(self):
+        for cmd, regex in self.dict.items():
+            if re.match(regex, self.lines[self.current_line]):
+                return cmd
+
+    def arg1(self):
+        cmd = self.commandType()
+        return re.match(self.dict[cmd], self.lines[self.current_line]).group(1)
+
+    def arg2(self):
+        cmd = self.commandType()
+        try:
+            return int(re.match(self.dict[cmd], self.lines[self.current_line]).group(2))
+        except IndexError:
+            return None
+
+
+def _compile_legacy(parser, writer):
+    """The query-driven translation loop used with LegacyParser."""
+    while parser.hasMoreCommands():
+        c_type = parser.commandType()
+        if c_type == "C_ARITHMETIC":
+            writer.writeArithmetic(parser.arg1())
+        if c_type == "C_PUSH":
+            writer.writePushPop("push", parser.arg1(), parser.arg2())
+        if c_type == "C_POP":
+            writer.writePushPop("pop", parser.arg1(), parser.arg2())
+        if c_type == "C_LABEL":
+            writer.writeLabel(parser.arg1())
+        if c_type == "C_GOTO":
+            writer.writeGoto(parser.arg1())
+        if c_type == "C_IF":
+            writer.writeIf(parser.arg1())
+        if c_type == "C_FUNCTION":
+            writer.writeFunction(parser.arg1(), parser.arg2())
+        if c_type == "C_CALL":
+            writer.writeCall(parser.arg1(), parser.arg2())
+        if c_type == "C_RETURN":
+            writer.writeReturn()
+        parser.advance()
+
+
+def _translate(parser_class, compile, bufferSize, vmfile, out):
+    start = perf_counter()
+    parser = parser_class(vmfile)
+    parsed = perf_counter()
+    writer = vm_compiler.CodeWriter(out, bufferSize)
+    writer.setFileName("Gen.vm")
+    compile(parser, writer)
+    writer.close()
+    return parsed - start, perf_counter() - start
+
+
+# name -> (parser, translation loop, lines buffered by CodeWriter, write to memory?)
+_variants = {
+    "legacy": (LegacyParser, _compile_legacy, 1, False),
+    "parsed": (vm_compiler.Parser, vm_compiler._compile, 1, False),
+    "buffered": (vm_compiler.Parser, vm_compiler._compile, 8192, False),
+    "memory": (vm_compiler.Parser, vm_compiler._compile, 8192, True),
+}
+
+
+def _pipeline(vmfile, asmfile, inMemory):
+    """Times translating and then assembling vmfile, either through an
+    .asm file on disk or through an in-memory text buffer."""
+    start = perf_counter()
+    if inMemory:
+        out = io.StringIO()
+        vm_compiler.compile(vmfile, outFile=out)
+        out.seek(0)
+        words = assembler_regex.assemble_stream(out)
+    else:
+        vm_compiler.compile(vmfile, outFile=asmfile)
+        with open(asmfile, 'r') as f:
+            words = assembler_regex.assemble_stream(f)
+    return perf_counter() - start, words
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the VM translator on generated input')
+    parser.add_argument("-n", help="commands per generated program", type=int,
+                        action="append", default=None)
+    parser.add_argument("-r", help="runs per variant (best is reported)", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        vmfile = os.path.join(tmp, "Gen.vm")
+        for commands in args.n or [100000, 300000]:
+            with open(vmfile, 'w') as f:
+                f.write(generate(commands))
+            outputs = set()
+            for name, (parser_class, compile, bufferSize, inMemory) in _variants.items():
+                asmfile = os.path.join(tmp, name + ".asm")
+                runs = []
+                for _ in range(args.r):
+                    out = io.StringIO() if inMemory else asmfile
+                    runs.append(_translate(parser_class, compile, bufferSize, vmfile, out))
+                parse, total = min(runs, key=lambda run: run[1])
+                if inMemory:
+                    outputs.add(out.getvalue())
+                else:
+                    with open(asmfile, 'r') as f:
+                        outputs.add(f.read())
+                print("%8d commands  %-9s parse %7.3fs  total %7.3fs  %9.0f commands/s" %
+                      (commands, name, parse, total, commands / total))
+            if len(outputs) != 1:
+                raise SystemExit("variants disagree on %d command input!" % commands)
+
+            asmfile = os.path.join(tmp, "pipeline.asm")
+            disk, diskWords = min(_pipeline(vmfile, asmfile, False) for _ in range(args.r))
+            memory, memoryWords = min(_pipeline(vmfile, asmfile, True) for _ in range(args.r))
+            if diskWords != memoryWords:
+                raise SystemExit("pipelines disagree on %d command input!" % commands)
+            print("%8d commands  vm->hack via .asm file %7.3fs, in memory %7.3fs" %
+                  (commands, disk, memory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# measures what the VM optimizer, and keeping the stack top in D, save at
+# run time, on the Hack emulator
+import argparse
+
+import vm_profiler
+
+
+# name -> options for vm_profiler.build
+_variants = {
+    "plain": {},
+    "fold": {"fold": True},
+    "inline": {"inline": True},
+    "both": {"fold": True, "inline": True},
+    "top": {"cacheTop": True},
+    "all": {"fold": True, "inline": True, "cacheTop": True},
+}
+
+
+def measure(target, **options):
+    """Builds target (a directory of .vm files, with bootstrap code) with
+    the options given to vm_profiler.build, and runs it up to Sys.halt.
+    Returns the Profiler, whose calls count the calls to every function."""
+    words, marks, sym = vm_profiler.build(target, True, **options)
+    profiler = vm_profiler.Profiler(words, marks)
+    profiler.run(until=sym.get("Sys.halt"))
+    return profiler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Counts the cycles and calls the VM optimizer saves')
+    parser.add_argument("targets", nargs="+", help="directories of .vm files, including the OS")
+    parser.add_argument("-t", help="Report the top N functions by calls saved (default: 5)",
+                        metavar="N", type=int, default=5)
+    parser.add_argument("-f", help="Report the cycles per call of this function "
+                        "(default: Screen.drawPixel and Output.printChar)",
+                        metavar="FUNCTION", action="append")
+    args = parser.parse_args()
+    focus = args.f or ["Screen.drawPixel", "Output.printChar"]
+    for target in args.targets:
+        base = None
+        for name, options in _variants.items():
+            profile = measure(target, **options)
+            if base is None:
+                base = profile
+            # the stack and temp segment hold leftovers that may differ, and
+            # inlining may change the order statics are allocated in
+            if base.machine.ram[2048:] != profile.machine.ram[2048:]:
+                raise SystemExit("%s: RAM differs with %s!" % (target, name))
+            calls = sum(base.calls.values())
+            saved = calls - sum(profile.calls.values())
+            print("%s %-6s %10d cycles (x%.2f); %d of %d calls eliminated" %
+                  (target, name, profile.machine.cycles,
+                   base.machine.cycles / max(profile.machine.cycles, 1), saved, calls))
+            inclusive = profile.inclusive()
+            for function in focus:
+                if profile.calls.get(function):
+                    print("  %-24s %8.1f cycles per call" %
+                          (function, inclusive[function] / profile.calls[function]))
+            savings = {function: count - profile.calls.get(function, 0)
+                       for function, count in base.calls.items()}
+            for function in sorted(savings, key=lambda function: -savings[function])[:args.t]:
+                if savings[function]:
+                    print("  %-24s %8d calls %8d eliminated" %
+                          (function, base.calls[function], savings[function]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# peephole optimizer for the assembly generated by CodeWriter
+#
+# Every rewrite below replaces a window of instructions with a shorter one
+# leaving A, D and memory as the original would, under assumptions that
+# hold for all code CodeWriter generates:
+#   - memory at and above SP is scratch: nothing reads a popped value
+#     from the stack once SP has moved below it.
+#   - SP never points at the first two words of RAM (it starts at 256),
+#     so a write through A = SP-1 never changes SP itself.
+#   - R13 only carries a value within the code of a single VM command.
+# Jump targets (labels) never rely on the value of A, as they can be
+# reached from several places.
+#
+# Comment lines (such as source map marks) are taken out before the
+# passes run and put back after, so that they never split a window.
+# Every line a pass writes keeps the origin -- the comments in effect --
+# of the first line of the window it came from.
+
+_PUSH = ["@SP", "M=M+1", "A=M-1", "M=D"]  # push D
+_POP = ["@SP", "M=M-1", "A=M", "D=M"]     # pop into D
+_PUSH_POP = _PUSH + _POP
+
+# names of the rewrites, for reporting
+POP_DIRECT = "pop to fixed address"
+POP_OFFSET = "pop to small offset"
+PUSH_POP = "push/pop pair"
+POP = "pop"
+POP_TOP = "pop, then reload top"
+TOP_RELOAD = "redundant top reload"
+
+
+def _count(stats, pattern, saved):
+    sites, total = stats.get(pattern, (0, 0))
+    stats[pattern] = (sites + 1, total + saved)
+
+
+_FIXED = {"5": 5, "THIS": 3}  # temp and pointer segments, at fixed addresses
+_MAX_OFFSET = 5  # beyond this, walking A up costs more than it saves
+
+
+def _popToSegment(lines, origins, stats):
+    """A pop into a segment computes the target address into R13 before
+    popping, as popping needs D. When the address is a constant, or a small
+    offset from a segment pointer, it is cheaper to pop first and compute
+    the address straight into A."""
+    out = []
+    outOrigins = []
+    i = 0
+    n = len(lines)
+    while i < n:
+        window = lines[i:i + 13] if i + 13 <= n and lines[i + 3] == "D=D+A" else None
+        if (window and window[2][0] == "@" and window[1] in ("D=A", "D=M") and
+                window[4:6] == ["@R13", "M=D"] and
+                window[6:10] == _POP and window[10:13] == ["@R13", "A=M", "M=D"] and
+                window[2][1:].isdigit()):
+            base, index = window[0][1:], int(window[2][1:])
+            if window[1] == "D=A" and base in _FIXED:
+                _emit(out, outOrigins, _POP + ["@" + str(_FIXED[base] + index), "M=D"], origins[i])
+                _count(stats, POP_DIRECT, 13 - 6)
+                i += 13
+                continue
+            if window[1] == "D=M" and index <= _MAX_OFFSET:
+                _emit(out, outOrigins, _POP + [window[0], "A=M"] + ["A=A+1"] * index + ["M=D"],
+                      origins[i])
+                _count(stats, POP_OFFSET, 13 - (7 + index))
+                i += 13
+                continue
+        out.append(lines[i])
+        outOrigins.append(origins[i])
+        i += 1
+    return out, outOrigins
+
+
+def _removePushPop(lines, origins, stats):
+    """A value pushed from D and immediately popped back into D never needs
+    to go through the stack. The pop leaves A pointing at the old stack top,
+    so that is kept unless the next instruction sets A anyway."""
+    out = []
+    outOrigins = []
+    i = 0
+    n = len(lines)
+    while i < n:
+        if lines[i] == "@SP" and lines[i:i + 8] == _PUSH_POP:
+            origin = origins[i]
+            i += 8
+            if i < n and lines[i][0] in "@(":
+                _count(stats, PUSH_POP, 8)
+            else:
+                _emit(out, outOrigins, ["@SP", "A=M"], origin)
+                _count(stats, PUSH_POP, 6)
+            continue
+        out.append(lines[i])
+        outOrigins.append(origins[i])
+        i += 1
+    return out, outOrigins
+
+
+def _fusePop(lines, origins, stats):
+    """Decrements SP and loads the new value into A in one instruction, and
+    derives the address of the next stack value from A instead of reloading
+    SP when the pop is followed by an operation on the stack top."""
+    out = []
+    outOrigins = []
+    i = 0
+    n = len(lines)
+    while i < n:
+        if lines[i] == "@SP" and lines[i:i + 4] == _POP:
+            if lines[i + 4:i + 6] == ["@SP", "A=M-1"]:
+                _emit(out, outOrigins, ["@SP", "AM=M-1", "D=M", "A=A-1"], origins[i])
+                _count(stats, POP_TOP, 2)
+                i += 6
+            else:
+                _emit(out, outOrigins, ["@SP", "AM=M-1", "D=M"], origins[i])
+                _count(stats, POP, 1)
+                i += 4
+            continue
+        out.append(lines[i])
+        outOrigins.append(origins[i])
+        i += 1
+    return out, outOrigins
+
+
+# what A is known to hold
+_UNKNOWN, _SP, _NEW_SP, _TOP = range(4)
+
+
+def _dropTopReloads(lines, origins, stats):
+    """Drops "@SP, A=M-1" wherever A already holds the address of the stack
+    top, e.g. between two operations on the top of the stack."""
+    out = []
+    outOrigins = []
+    a = _UNKNOWN
+    i = 0
+    n = len(lines)
+    while i < n:
+        line = lines[i]
+        if line == "@SP":
+            if a == _TOP and i + 1 < n and lines[i + 1] == "A=M-1":
+                _count(stats, TOP_RELOAD, 2)
+                i += 2
+                continue
+            a = _SP
+        elif line[0] in "@(":
+            a = _UNKNOWN
+        else:
+            dest = line.split("=", 1)[0] if "=" in line else ""
+            if a == _SP and line == "A=M-1":
+                a = _TOP
+            elif a == _SP and line == "AM=M-1":
+                a = _NEW_SP
+            elif a == _NEW_SP and line == "A=A-1":
+                a = _TOP
+            elif "A" in dest:
+                a = _UNKNOWN
+            elif a == _NEW_SP and "M" in dest:
+                a = _UNKNOWN
+        out.append(line)
+        outOrigins.append(origins[i])
+        i += 1
+    return out, outOrigins
+
+
+def _emit(out, outOrigins, lines, origin):
+    out.extend(lines)
+    outOrigins.extend([origin] * len(lines))
+
+
+def optimize(lines, stats=None):
+    """Returns an optimized copy of the assembly lines. For every rewrite
+    applied, stats (if given) maps its name to (sites, instructions saved)."""
+    if stats is None:
+        stats = {}
+    code = []
+    origins = []
+    comments = [[]]  # comment lines, by origin
+    for line in lines:
+        if line.startswith("//"):
+            if code and origins[-1] == len(comments) - 1:
+                comments.append([])  # comments after code start a new origin
+            comments[-1].append(line)
+        else:
+            code.append(line)
+            origins.append(len(comments) - 1)
+    for rewrite in (_popToSegment, _removePushPop, _fusePop, _dropTopReloads):
+        code, origins = rewrite(code, origins, stats)
+    if len(comments) == 1 and not comments[0]:
+        return code
+    out = []
+    origin = -1
+    for line, lineOrigin in zip(code, origins):
+        if lineOrigin != origin:
+            origin = lineOrigin
+            out.extend(comments[origin])
+        out.append(line)
+    if origin < len(comments) - 1:
+        out.extend(comments[-1])  # trailing comments
+    return out
+
+
+def report(stats):
+    """Returns a line per rewrite describing how much it saved."""
+    return ["%-22s %7d sites %8d instructions saved" % (pattern, sites, saved)
+            for pattern, (sites, saved) in sorted(stats.items())]
@@ -1,42 +1,116 @@
 #!/usr/bin/env python3
 # compiles VM code into ASM
+import io
 import os
-import re
+import sys
+import json
+import hashlib
 import argparse
 
+import peephole
+
+
+# command types, as opcodes for Command.type
+(C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO,
+ C_IF, C_FUNCTION, C_RETURN, C_CALL) = range(9)
+
+_command_names = ["C_ARITHMETIC", "C_PUSH", "C_POP", "C_LABEL", "C_GOTO",
+                  "C_IF", "C_FUNCTION", "C_RETURN", "C_CALL"]
+
+# first word of a command -> (command type, number of arguments)
+_command_forms = {
+    "add": (C_ARITHMETIC, 0),
+    "sub": (C_ARITHMETIC, 0),
+    "neg": (C_ARITHMETIC, 0),
+    "eq": (C_ARITHMETIC, 0),
+    "gt": (C_ARITHMETIC, 0),
+    "lt": (C_ARITHMETIC, 0),
+    "and": (C_ARITHMETIC, 0),
+    "or": (C_ARITHMETIC, 0),
+    "not": (C_ARITHMETIC, 0),
+    "push": (C_PUSH, 2),
+    "pop": (C_POP, 2),
+    "label": (C_LABEL, 1),
+    "goto": (C_GOTO, 1),
+    "if-goto": (C_IF, 1),
+    "function": (C_FUNCTION, 2),
+    "call": (C_CALL, 2),
+    "return": (C_RETURN, 0)
+}
+
+_segments = {"local", "argument", "this", "that", "temp", "pointer", "static", "constant"}
+
+# static variables go in RAM 16 to 255, below the stack
+_MAX_STATICS = 240
+
+
+def _die_with_err_msg(in_line_ct, msg):
+    raise RuntimeError("Line %d:\n\t%s" % (in_line_ct, msg))
+
+
+class Command():
+    """A single parsed VM command.
+    type is one of the C_* opcodes. arg1 is the segment, label or function
+    name (the command itself for C_ARITHMETIC), and arg2 the index, local
+    count or argument count, as an int (None if the command has none).
+    line is the line of the source file the command came from.
+    file names the .vm file a static segment belongs to, when it is not the
+    file being translated (as in code inlined from another file)."""
+    __slots__ = ("type", "arg1", "arg2", "line", "file")
+
+    def __init__(self, type, arg1, arg2, line, file=None):
+        self.type = type
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.line = line
+        self.file = file
+
 
 class Parser():
     def __init__(self, file):
         with open(file, 'r') as f:
-            lines = f.readlines()
-        lines = map(self._cleanLine, lines)
-        self.lines = list(filter(None, lines))  # remove lines with no code
+            try:
+                self.commands = self._parse(f)
+            except RuntimeError as err:
+                raise RuntimeError("%s: %s" % (file, err.args[0]))
         self.current_line = 0
-        self.dict = {
-            "C_ARITHMETIC": "(add|and|neg|not|or|sub|eq|gt|lt)",
-            "C_LABEL": "label ([\w_.][\d\w_.]*)",
-            "C_GOTO": "goto ([\w_.][\d\w_.]*)",
-            "C_IF": "if-goto ([\w_.][\d\w_.]*)",
-            "C_PUSH": "push (local|argument|this|that|temp|pointer|static|constant) (\d+)",
-            "C_POP": "pop (local|argument|this|that|temp|pointer|static|constant) (\d+)",
-            "C_FUNCTION": "function ([\w_.][\d\w_.]*) (\d+)",
-            "C_CALL": "call ([\w_.][\d\w_.]*) (\d)+",
-            "C_RETURN": "return"
-        }
 
 
     @staticmethod
-    def _cleanLine(line):
-        # remove the following:
-        line = re.sub('^\s*', '', line)  # leading spaces
-        line = re.sub('\s\s*', ' ', line)  # duplicated spaces
-        line = re.sub('//.*$', '', line)  # in-line comments
-        return line
+    def _parse(lines):
+        """Tokenizes every line once, returning the Commands of the lines with code."""
+        commands = []
+        forms = _command_forms
+        for line_ct, line in enumerate(lines, 1):
+            words = line.split("//", 1)[0].split()
+            if not words:
+                continue  # no code on this line
+            try:
+                c_type, argc = forms[words[0]]
+            except KeyError:
+                _die_with_err_msg(line_ct, "unknown command!\n\t%s" % line.strip())
+            if len(words) != argc + 1:
+                _die_with_err_msg(line_ct, "%s takes %d arguments!\n\t%s" %
+                                  (words[0], argc, line.strip()))
+            if argc == 0:
+                arg1 = words[0] if c_type == C_ARITHMETIC else None
+                arg2 = None
+            else:
+                arg1 = words[1]
+                arg2 = None
+                if argc == 2:
+                    if not words[2].isdigit():
+                        _die_with_err_msg(line_ct, "invalid number!\n\t%s" % line.strip())
+                    arg2 = int(words[2])
+                    if c_type in (C_PUSH, C_POP) and arg1 not in _segments:
+                        _die_with_err_msg(line_ct, "unknown segment!\n\t%s" % line.strip())
+            commands.append(Command(c_type, arg1, arg2, line_ct))
+        return commands
 
 
     def hasMoreCommands(self):
         """Returns whether there are still commands to be processed by the parser."""
-        return self.current_line < len(self.lines)
+        return self.current_line < len(self.commands)
 
 
     def advance(self):
@@ -44,34 +118,93 @@ class Parser():
         self.current_line += 1
 
 
+    def command(self):
+        """Returns the Command on the current line."""
+        return self.commands[self.current_line]
+
+
     def commandType(self):
         """Returns the command type of the current line, which will be one of:
         C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION, C_RETURN, C_CALL"""
-        for cmd, regex in self.dict.items():
-            if re.match(regex, self.lines[self.current_line]):
-                return cmd
+        return _command_names[self.commands[self.current_line].type]
 
 
     def arg1(self):
         """Returns first argument of the command on the current line.
         If the current line is a C_ARITHMETIC command, returns the name of the command itself."""
-        cmd = self.commandType()
-        return re.match(self.dict[cmd], self.lines[self.current_line]).group(1)
+        return self.commands[self.current_line].arg1
 
 
     def arg2(self):
         """Returns the second argument of the command on the current line.
         Returns None for any command other than C_PUSH, C_POP, C_FUNCTION, C_CALL."""
-        cmd = self.commandType()
-        try:
-            return re.match(self.dict[cmd], self.lines[self.current_line]).group(2)
-        except IndexError:
-            return None
+        return self.commands[self.current_line].arg2
+
+
+# labels of the routines shared by all calls and returns with sharedCalls,
+# and by all comparisons with sharedCompares
+_SHARED_CALL = "VM$call"
+_SHARED_RETURN = "VM$return"
+_SHARED_COMPARE = {"eq": "VM$eq", "lt": "VM$lt", "gt": "VM$gt"}
+
+# with cacheTop, a pop walks A up from a segment pointer up to this many
+# times; beyond that, computing the address through R13/R14 is cheaper
+_MAX_WALK = 9
 
 
 class CodeWriter():
-    def __init__(self, outFile):
-        self.outFile = open(outFile, 'w')
+    def __init__(self, outFile, bufferSize=8192, optimize=False, sharedCalls=False,
+                 sharedCompares=False, sourceMap=False, fold=False, inline=None, keep=None,
+                 cacheTop=False):
+        """outFile is either a path to write to, or any text sink with a
+        write method (io.StringIO, a pipe, ...), which is left open on close.
+        Generated lines are buffered and written bufferSize lines at a time.
+        If optimize is set, each buffer goes through the peephole optimizer
+        before it is written, and peepholeStats collects what it saved.
+        If sharedCalls is set, calls and returns jump to a single copy of the
+        calling sequence, written by writeSharedRoutines, trading a few
+        cycles per call for much smaller code. Likewise, sharedCompares
+        makes eq, lt and gt calls to a single routine for each.
+        If sourceMap is set, the code of every VM command is preceded by a
+        "// vm <file> <line> <function> <command>" comment, which the
+        assembler can turn into a map from ROM addresses to VM commands.
+        If fold is set, the VM commands of each file go through
+        vm_optimizer.fold before translation, and foldStats collects what
+        it saved. inline, if given, maps the names of the functions to
+        inline at their call sites to their bodies (see vm_optimizer.leaves);
+        inlineStats collects what it saved. Inlining comes before folding.
+        keep, if given, is the set of the only functions to translate.
+        If cacheTop is set, the top of the stack is kept in D from one
+        command to the next where possible, and only written back to the
+        stack before labels, jumps, calls and returns.
+        romWords and labels count the instructions and labels written, and
+        statics collects the names of the static variables used."""
+        if isinstance(outFile, str):
+            self.outFile = open(outFile, 'w')
+            self._ownsFile = True
+        else:
+            self.outFile = outFile
+            self._ownsFile = False
+        self._buffer = []
+        self._bufferMarks = 0
+        self._bufferSize = bufferSize
+        self.optimize = optimize
+        self.peepholeStats = {}
+        self.sharedCalls = sharedCalls
+        self.sharedCompares = sharedCompares
+        self.sourceMap = sourceMap
+        self.fold = fold
+        self.foldStats = {}
+        self.inline = inline
+        self.inlineStats = {}
+        self.keep = keep
+        self.cacheTop = cacheTop
+        self._topInD = False  # the stack top is in D, not yet in memory
+        self.removed = []  # names of the functions left out, set by compile()
+        self.romWords = 0
+        self.labels = 0
+        self.statics = set()
+        self.fileName = ""  # bootstrap code precedes every file
         self.cmpcount = 0
         self.current_function = ""  # global scope at start
         self.mem_dict = {
@@ -87,13 +220,23 @@ class CodeWriter():
 
     def setFileName(self, fileName):
         """Informs codewriter that translation of new vm file is started,
-        and sets the name of the current file."""
+        and sets the name of the current file.
+
+        Generated labels are numbered per file and qualified with the file
+        name, so the code written for a file does not depend on any file
+        translated before it."""
+        self._spill()
         self.fileName = fileName
+        self.current_function = ""
+        self.cmpcount = 0
+        self.call_count = 0
 
 
     def writeInit(self):
         """Output bootstrap code needed to interface with OS.
         Sets up the stack and runs Sys.init."""
+        self._spill()
+        self.writeSourceMark(0, "bootstrap")
         # push 256 to SP
         self._writeAsm(["@256",
                         "D=A",
@@ -104,28 +247,42 @@ class CodeWriter():
 
     def writeArithmetic(self, command):
         """Writes the arithmetic command specified by command.
-        command must be one of "add", "and", "or", "not", "neg", "eq", "lt", "gt"."""
-        assert(command in ["add", "and", "or", "not", "neg", "eq", "lt", "gt"])
-        
+        command must be one of "add", "sub", "and", "or", "not", "neg", "eq", "lt", "gt"."""
+        assert(command in ["add", "sub", "and", "or", "not", "neg", "eq", "lt", "gt"])
+
+        if self.cacheTop and not (command in _SHARED_COMPARE and self.sharedCompares):
+            self._writeCachedArithmetic(command)
+            return
+        self._spill()
         if command in ["not", "neg"]:
             cmd = {"not": "!", "neg": "-"}[command]
             self._writeAsm(["@SP",
                             "A=M-1",
                             "M=" + cmd + "M"])
+        elif command in ["eq", "lt", "gt"] and self.sharedCompares:
+            # D = return address, see writeSharedRoutines
+            self.cmpcount += 1
+            return_address = self._uniqueLabel(command, self.cmpcount)
+            self._setAddress(return_address)
+            self._saveAddress()
+            self._writeGoto(_SHARED_COMPARE[command])
+            self._writeLabel(return_address)
         elif command in ["eq", "lt", "gt"]:
             self.cmpcount += 1
             jmp = {"eq": "JEQ", "lt": "JLT", "gt": "JGT"}[command]
+            true_label = self._uniqueLabel(command, self.cmpcount)
+            done_label = self._uniqueLabel("DONE", self.cmpcount)
             self._popFromStack()
             self._writeAsm(["A=A-1",
                             "D=M-D",
-                            "@" + command + str(self.cmpcount),
+                            "@" + true_label,
                             "D;" + jmp,
                             "D=0",
-                            "@DONE." + str(self.cmpcount),
+                            "@" + done_label,
                             "0;JMP",
-                            "(" + command + str(self.cmpcount) + ")",
+                            "(" + true_label + ")",
                             "D=-1",
-                            "(DONE." + str(self.cmpcount) + ")",
+                            "(" + done_label + ")",
                             "@SP",
                             "A=M-1",
                             "M=D"])
@@ -137,21 +294,25 @@ class CodeWriter():
                             "M=M" + cmd + "D"])
 
 
-    def writePushPop(self, command, segment, index):
+    def writePushPop(self, command, segment, index, fileName=None):
         """Write a push/pop statement to the specified memory location.
         command must be one of "push","pop".
         segment must be on of "local","argument","this","that","temp","pointer","static","constant".
-        index must be a non-negative integer."""
+        index must be a non-negative integer.
+        fileName selects the static segment of another file than the current one."""
         assert(command in ["push", "pop"])
         assert(segment in ["local", "argument", "this", "that", "temp", "pointer", "static", "constant"])
-        
+
+        if self.cacheTop:
+            self._writeCachedPushPop(command, segment, index, fileName)
+            return
         if segment == "constant":
             self._writePushConstant(index)
         elif segment == "static":
             if command == "push":
-                self._writePushStatic(index)
+                self._writePushStatic(index, fileName)
             elif command == "pop":
-                self._writePopStatic(index)
+                self._writePopStatic(index, fileName)
         elif segment in ["temp", "pointer", "static"]:
             mem = self.mem_dict[segment]
             addr = "A"
@@ -174,35 +335,59 @@ class CodeWriter():
 
     def writeLabel(self, label):
         """Writes the specified label."""
+        self._spill()
         self._writeLabel(self._localLabel(label))
 
 
     def _writeGoto(self, label):
         self._setAddress(label)
-        self.outFile.write("0;JMP\n")
+        self._writeAsm(["0;JMP"])
 
 
     def writeGoto(self, label):
         """Write an unconditional goto that jumps to label."""
+        self._spill()
         self._writeGoto(self._localLabel(label))
 
 
     def _writeIf(self, label):
         self._popFromStack()
         self._setAddress(label)
-        self.outFile.write("D;JNE\n")
+        self._writeAsm(["D;JNE"])
 
 
     def writeIf(self, label):
         """Write a conditional jump to label."""
-        self._writeIf(self._localLabel(label))
+        if self._topInD:
+            self._setAddress(self._localLabel(label))
+            self._writeAsm(["D;JNE"])
+            self._topInD = False
+        else:
+            self._writeIf(self._localLabel(label))
 
 
     def writeCall(self, functionName, numArgs):
         """Writes a call to the function functionName, with numArgs arguments currently on the stack."""
+        self._spill()
         self.call_count += 1
 
-        return_address = "call$" + functionName + "." + str(self.call_count)
+        return_address = self._uniqueLabel("call$" + functionName, self.call_count)
+        if self.sharedCalls:
+            # R13 = function, R14 = n + 5, D = return address
+            self._setAddress(functionName)
+            self._saveAddress()
+            self._setAddress("R13")
+            self._setMemory()
+            self._setAddress(str(numArgs + 5))
+            self._saveAddress()
+            self._setAddress("R14")
+            self._setMemory()
+            self._setAddress(return_address)
+            self._saveAddress()
+            self._writeGoto(_SHARED_CALL)
+            self._writeLabel(return_address)
+            return
+
         self._setAddress(return_address)
         self._saveAddress()
         self._pushToStack() # push return address
@@ -237,8 +422,23 @@ class CodeWriter():
         self._writeLabel(return_address)
 
 
+    def writeSourceMark(self, line, command, function=None):
+        """With sourceMap set, marks the code written next as that of the
+        VM command named command (e.g. "push") on line of the current file,
+        within function (by default, the current one)."""
+        if self.sourceMap:
+            # not counted towards the buffer size, so that marks never move
+            # where the peephole optimizer's input is split
+            self._buffer.append("// vm %s %d %s %s" % (self.fileName or "-", line,
+                                                       function or self.current_function or "-",
+                                                       command))
+            self._bufferMarks += 1
+
+
     def writeFunction(self, functionName, numLocals):
         """Writes the beginning of the function with the name functionName, and numLocals local variables."""
+        self._spill()
+        self.current_function = functionName
         self._writeLabel(functionName)
 
         for _ in range(numLocals):
@@ -249,11 +449,83 @@ class CodeWriter():
 
     def writeReturn(self):
         """Write a return instruction.
-        
-        todo: code size for a function with several returns could be optimized
-        by writing only one return statement for each function at the end, and then only
-        writing a goto to that return statement here."""
-        
+        With sharedCalls, this is a jump to the shared return routine."""
+        self._spill()
+        if self.sharedCalls:
+            self._writeGoto(_SHARED_RETURN)
+        else:
+            self._writeReturnCode()
+
+
+    def writeSharedRoutines(self):
+        """Writes the call and return routines used with sharedCalls, and
+        the comparison routines used with sharedCompares.
+        This must come after code that ends by falling through, e.g. at the
+        very end of the program, and be written exactly once."""
+        self._spill()
+        self.fileName = ""
+        self.current_function = ""
+        if self.sharedCalls:
+            self.writeSourceMark(0, "call")
+            self._writeSharedCall()
+        if self.sharedCompares:
+            for command, jmp in [("eq", "JEQ"), ("lt", "JLT"), ("gt", "JGT")]:
+                self.writeSourceMark(0, command)
+                self._writeSharedCompare(command, jmp)
+
+
+    def _writeSharedCompare(self, command, jmp):
+        # called with D = return address, replaces the top two values with
+        # -1 (true) or 0 (false)
+        label = _SHARED_COMPARE[command]
+        self._writeLabel(label)
+        self._setAddress("R15")
+        self._setMemory()
+        self._popFromStack()
+        self._writeAsm(["A=A-1",
+                        "D=M-D",
+                        "M=-1",
+                        "@" + label + ".true",
+                        "D;" + jmp,
+                        "@SP",
+                        "A=M-1",
+                        "M=0",
+                        "(" + label + ".true)"])
+        self._setAddress("R15")
+        self._dereference()
+        self._writeAsm(["0;JMP"])
+
+
+    def _writeSharedCall(self):
+        # called with R13 = function, R14 = n + 5, D = return address
+        self._writeLabel(_SHARED_CALL)
+        self._pushToStack() # push return address
+        for pointer in ["LCL", "ARG", "THIS", "THAT"]:
+            self._setAddress(pointer)
+            self._saveMemory()
+            self._pushToStack()
+
+        self._setAddress("R14")
+        self._saveMemory()
+        self._setAddress("SP")
+        self._writeAsm(["D=M-D"])
+        self._setAddress("ARG")
+        self._setMemory() # set ARG = SP - n - 5
+        self._setAddress("SP")
+        self._saveMemory()
+        self._setAddress("LCL")
+        self._setMemory() # set LCL = SP
+
+        self._setAddress("R13")
+        self._dereference()
+        self._writeAsm(["0;JMP"])
+
+        self.writeSourceMark(0, "return")
+        self._writeLabel(_SHARED_RETURN)
+        self._writeReturnCode()
+
+
+    def _writeReturnCode(self):
         # FRAME = LCL
         self._setAddress("LCL")
         self._saveMemory()
@@ -326,9 +598,44 @@ class CodeWriter():
         self._writeAsm(["0;JMP"])
 
 
+    def writeAssembly(self, text):
+        """Writes already translated assembly text, such as a cached translation."""
+        self._spill()
+        if self.optimize:
+            lines = text.splitlines()
+            self._bufferMarks += sum(1 for line in lines if line[0] == "/")
+            self._writeAsm(lines)
+        else:
+            self.flush()
+            self._countWritten(text.splitlines())
+            self.outFile.write(text)
+
+
+    def flush(self):
+        """Writes out all buffered lines."""
+        if self._buffer:
+            if self.optimize:
+                self._buffer = peephole.optimize(self._buffer, self.peepholeStats)
+            self._countWritten(self._buffer)
+            self._buffer.append("")  # for the final newline
+            self.outFile.write("\n".join(self._buffer))
+            self._buffer.clear()
+            self._bufferMarks = 0
+
+
+    def _countWritten(self, lines):
+        labels = sum(1 for line in lines if line[0] == "(")
+        comments = sum(1 for line in lines if line[0] == "/")
+        self.labels += labels
+        self.romWords += len(lines) - labels - comments
+
+
     def close(self):
         """Closes the output file and performs all other necessary end of compile tasks."""
-        self.outFile.close()
+        self._spill()
+        self.flush()
+        if self._ownsFile:
+            self.outFile.close()
 
 
     def _saveMemory(self):
@@ -343,6 +650,10 @@ class CodeWriter():
         return self.current_function + "." + label
 
 
+    def _uniqueLabel(self, kind, count):
+        return self.fileName + "$" + kind + "." + str(count)
+
+
     def _pushToStack(self):
         """Pushes the value in D onto the stack"""
         self._writeAsm(["@SP",
@@ -359,6 +670,22 @@ class CodeWriter():
                         "D=M"])
 
 
+    def _spill(self):
+        """With cacheTop, writes the stack top held in D back to the stack."""
+        if self._topInD:
+            self._pushToStack()
+            self._topInD = False
+
+
+    def _loadTop(self):
+        """With cacheTop, makes sure the stack top is in D, and not on the stack."""
+        if not self._topInD:
+            self._writeAsm(["@SP",
+                            "AM=M-1",
+                            "D=M"])
+            self._topInD = True
+
+
     def _dereference(self):
         self._writeAsm(["A=M"])
 
@@ -375,31 +702,33 @@ class CodeWriter():
         self._writeAsm(["D=A"])
 
 
-    def _staticName(self, index):
-        return self.fileName + "." + str(index)
+    def _staticName(self, index, fileName=None):
+        name = (fileName or self.fileName) + "." + str(index)
+        self.statics.add(name)
+        return name
 
 
     def _writeAsm(self, lines):
-        for line in lines:
-            self.
-            .write(line + "\n")
+        self._buffer.extend(lines)
+        if len(self._buffer) - self._bufferMarks >= self._bufferSize:
+            self.flush()
 
 
     def _writePushConstant(self, val):
-        self._writeAsm(["@" + val,
+        self._writeAsm(["@" + str(val),
                         "D=A"])
         self._pushToStack()
 
 
-    def _writePushStatic(self, index):
-        label = self._staticName(index)
+    def _writePushStatic(self, index, fileName=None):
+        label = self._staticName(index, fileName)
         self._writeAsm(["@" + label,
                         "D=M"])
         self._pushToStack()
 
 
-    def _writePopStatic(self, index):
-        label = self._staticName(index)
+    def _writePopStatic(self, index, fileName=None):
+        label = self._staticName(index, fileName)
         self._popFromStack()
         self._writeAsm(["@" + label,
                         "M=D"])
@@ -427,82 +756,409 @@ class CodeWriter():
                         "M=D"])
 
 
-def _compile(parser, writer):
-    while parser.hasMoreCommands():
-        c_type = parser.commandType()
-        if c_type == "C_ARITHMETIC":
-            writer.writeArithmetic(parser.arg1())
-        if c_type == "C_PUSH":
-            writer.writePushPop("push", parser.arg1(), parser.arg2())
-        if c_type == "C_POP":
-            writer.writePushPop("pop", parser.arg1(), parser.arg2())
-        if c_type == "C_LABEL":
-            writer.writeLabel(parser.arg1())
-        if c_type == "C_GOTO":
-            writer.writeGoto(parser.arg1())
-        if c_type == "C_IF":
-            writer.writeIf(parser.arg1())
-        if c_type == "C_FUNCTION":
-            writer.writeFunction(parser.arg1(), int(parser.arg2()))
-        if c_type == "C_CALL":
-            writer.writeCall(parser.arg1(), int(parser.arg2()))
-        if c_type == "C_RETURN":
-            writer.writeReturn()
-        parser.advance()
+    def _writeCachedArithmetic(self, command):
+        if command in ["not", "neg"]:
+            cmd = {"not": "!", "neg": "-"}[command]
+            if self._topInD:
+                self._writeAsm(["D=" + cmd + "D"])
+            else:
+                self._writeAsm(["@SP",
+                                "A=M-1",
+                                "M=" + cmd + "M"])
+            return
+        self._loadTop()  # y
+        self._writeAsm(["@SP",
+                        "AM=M-1"])  # x, now in M
+        if command in ["eq", "lt", "gt"]:
+            self.cmpcount += 1
+            jmp = {"eq": "JEQ", "lt": "JLT", "gt": "JGT"}[command]
+            true_label = self._uniqueLabel(command, self.cmpcount)
+            done_label = self._uniqueLabel("DONE", self.cmpcount)
+            self._writeAsm(["D=M-D",
+                            "@" + true_label,
+                            "D;" + jmp,
+                            "D=0",
+                            "@" + done_label,
+                            "0;JMP",
+                            "(" + true_label + ")",
+                            "D=-1",
+                            "(" + done_label + ")"])
+        else:
+            self._writeAsm([{"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M"}[command]])
+
+
+    def _writeCachedPushPop(self, command, segment, index, fileName=None):
+        if segment == "static":
+            target = ["@" + self._staticName(index, fileName)]
+        elif segment in ["temp", "pointer"]:
+            target = ["@" + str({"temp": 5, "pointer": 3}[segment] + index)]
+        elif segment != "constant" and (index <= _MAX_WALK or command == "push"):
+            target = ["@" + self.mem_dict[segment], "A=M"] + ["A=A+1"] * index
+        else:
+            target = None
+        if command == "push":
+            self._spill()
+            if segment == "constant":
+                self._writeAsm(["@" + str(index),
+                                "D=A"])
+            elif index > 1 and segment not in ["static", "temp", "pointer"]:
+                self._writeAsm(["@" + self.mem_dict[segment],
+                                "D=M",
+                                "@" + str(index),
+                                "A=D+A",
+                                "D=M"])
+            else:
+                self._writeAsm(target + ["D=M"])
+            self._topInD = True
+            return
+        if target is not None:
+            self._loadTop()
+            self._writeAsm(target + ["M=D"])
+        elif self._topInD:
+            self._writeAsm(["@R13",
+                            "M=D",  # the value
+                            "@" + self.mem_dict[segment],
+                            "D=M",
+                            "@" + str(index),
+                            "D=D+A",
+                            "@R14",
+                            "M=D",  # the address
+                            "@R13",
+                            "D=M",
+                            "@R14",
+                            "A=M",
+                            "M=D"])
+        else:
+            self._writePop(self.mem_dict[segment], index, "M")
+        self._topInD = False
+
 
+# command words, for source map marks
+_command_words = {C_PUSH: "push", C_POP: "pop", C_LABEL: "label", C_GOTO: "goto", C_IF: "if-goto",
+                  C_FUNCTION: "function", C_CALL: "call", C_RETURN: "return"}
 
-def compile(target, bootstrap=False):
+
+def _keptFunctions(commands, keep):
+    out = []
+    kept = True
+    for cmd in commands:
+        if cmd.type == C_FUNCTION:
+            kept = cmd.arg1 in keep
+        if kept:
+            out.append(cmd)
+    return out
+
+
+def _compile(parser, writer):
+    commands = parser.commands
+    if writer.keep is not None:
+        commands = _keptFunctions(commands, writer.keep)
+    if writer.inline:
+        import vm_optimizer
+        commands = vm_optimizer.inline(commands, writer.inline, writer.inlineStats)
+    if writer.fold:
+        import vm_optimizer
+        commands = vm_optimizer.fold(commands, writer.foldStats)
+    mark = writer.sourceMap
+    for cmd in commands:
+        c_type = cmd.type
+        if mark:
+            if c_type == C_ARITHMETIC:
+                writer.writeSourceMark(cmd.line, cmd.arg1)
+            elif c_type == C_FUNCTION:
+                writer.writeSourceMark(cmd.line, "function", cmd.arg1)
+            else:
+                writer.writeSourceMark(cmd.line, _command_words[c_type])
+        if c_type == C_PUSH:
+            writer.writePushPop("push", cmd.arg1, cmd.arg2, cmd.file)
+        elif c_type == C_ARITHMETIC:
+            writer.writeArithmetic(cmd.arg1)
+        elif c_type == C_POP:
+            writer.writePushPop("pop", cmd.arg1, cmd.arg2, cmd.file)
+        elif c_type == C_LABEL:
+            writer.writeLabel(cmd.arg1)
+        elif c_type == C_GOTO:
+            writer.writeGoto(cmd.arg1)
+        elif c_type == C_IF:
+            writer.writeIf(cmd.arg1)
+        elif c_type == C_FUNCTION:
+            writer.writeFunction(cmd.arg1, cmd.arg2)
+        elif c_type == C_CALL:
+            writer.writeCall(cmd.arg1, cmd.arg2)
+        elif c_type == C_RETURN:
+            writer.writeReturn()
+    parser.current_line = len(parser.commands)
+
+
+_versions = {}  # source file -> hash of its content
+
+def _translatorVersion(*modules):
+    """Returns a hash of this translator's source, and of the source of
+    modules, which rewrite its input, so that cached output is never
+    reused across changes to the translator itself."""
+    version = b""
+    for file in [__file__] + [module.__file__ for module in modules]:
+        if file not in _versions:
+            with open(file, 'rb') as f:
+                _versions[file] = hashlib.sha1(f.read()).digest()
+        version += _versions[file]
+    return version
+
+
+def _cachedTranslation(file, cacheDir, sharedCalls=False, sharedCompares=False, sourceMap=False,
+                       fold=False, inline=None, keep=None, cacheTop=False):
+    """Returns the assembly for a single .vm file, from cacheDir if this
+    exact file content has been translated before by this translator,
+    with the same options (and, if inlining, the same functions to inline,
+    and if leaving out functions, the same functions to keep), along with
+    the inlineStats, foldStats and statics of its translation, which are
+    cached with it.
+
+    The assembly for a file only depends on its name and content, as
+    CodeWriter numbers generated labels per file, so fragments from the
+    cache can be freely combined with freshly translated ones."""
+    with open(file, 'rb') as f:
+        data = f.read()
+    name = os.path.basename(file)
+    mode = b"calls=%d,compares=%d,map=%d,fold=%d,top=%d\0" % (sharedCalls, sharedCompares,
+                                                               sourceMap, fold, cacheTop)
+    optimizers = []
+    if fold or inline:
+        import vm_optimizer
+        optimizers = [vm_optimizer]
+    if inline:
+        mode += vm_optimizer.signature(inline) + b"\0"
+    if keep is not None:
+        mode += repr(sorted(keep)).encode() + b"\0"
+    key = hashlib.sha1(_translatorVersion(*optimizers) + mode + name.encode() + b"\0" + data).hexdigest()
+    cacheFile = os.path.join(cacheDir, key + ".asm")
+    statsFile = os.path.join(cacheDir, key + ".json")
+    if not os.path.exists(cacheFile):
+        os.makedirs(cacheDir, exist_ok=True)
+        tmpFile = "%s.%d.tmp" % (cacheFile, os.getpid())
+        codeWriter = CodeWriter(tmpFile, sharedCalls=sharedCalls, sharedCompares=sharedCompares,
+                                sourceMap=sourceMap, fold=fold, inline=inline, keep=keep,
+                                cacheTop=cacheTop)
+        codeWriter.setFileName(name)
+        _compile(Parser(file), codeWriter)
+        codeWriter.close()
+        # the stats go first, so they are there whenever the assembly is
+        with open(tmpFile + ".json", 'w') as f:
+            json.dump({"inline": codeWriter.inlineStats, "fold": codeWriter.foldStats,
+                       "statics": sorted(codeWriter.statics)}, f)
+        os.replace(tmpFile + ".json", statsFile)
+        os.replace(tmpFile, cacheFile)  # atomic, so concurrent builds never see partial output
+    with open(cacheFile, 'r') as f:
+        text = f.read()
+    with open(statsFile, 'r') as f:
+        stats = json.load(f)
+    return text, stats["inline"], stats["fold"], stats["statics"]
+
+
+def _addStats(total, stats):
+    """Adds stats (as collected by vm_optimizer) to total."""
+    for rewrite, (sites, saved) in stats.items():
+        totalSites, totalSaved = total.get(rewrite, (0, 0))
+        total[rewrite] = (totalSites + sites, totalSaved + saved)
+
+
+def _checkStatics(writer, target):
+    if len(writer.statics) > _MAX_STATICS:
+        raise RuntimeError("%s: %d static variables, but only %d fit in RAM (16 to 255)" %
+                           (target, len(writer.statics), _MAX_STATICS))
+
+
+def _reachable(program, bootstrap, leaves):
+    """Returns the functions of program (a list of (file name, Commands))
+    that may run: those reachable from Sys.init, and without bootstrap
+    code, from the first function, which the program starts in. Returns
+    None, to keep every function, if the program has no Sys.init."""
+    import vm_optimizer
+    defined = [name for file, commands in program for name in vm_optimizer.functions(commands)]
+    if "Sys.init" not in defined:
+        return None
+    roots = ["Sys.init"] if bootstrap else ["Sys.init", defined[0]]
+    return vm_optimizer.reachable(program, roots, leaves)
+
+
+def compile(target, bootstrap=False, cache=False, outFile=None, optimize=False,
+            sharedCalls=False, sharedCompares=False, sourceMap=False, fold=False, inline=False,
+            prune=False, cacheTop=False):
     """Compiles the target specified, optionally appending bootstrap code.
     
     If the target path is a directory, we compile all files in the directory 
     with the extension ".vm" and write the output to a single assembly file.
     This file is placed in (and has the same name as) the target directory.
+    If cache is set, the assembly for each file is kept in the directory's
+    .vmcache subdirectory, keyed on the file's content, and reused by later
+    compiles so only changed files are translated again.
     
     If the target path is a file, we compile it and write the output
     to a file with the same name and the extension ".asm".
+
+    outFile overrides where the output goes, and may be a path or a text
+    sink such as io.StringIO, e.g. to pass the assembly straight to the
+    assembler without going through a file.
+
+    If optimize is set, the output goes through the peephole optimizer
+    (cached translations are stored unoptimized, and optimized on use).
+    If sharedCalls is set, calls and returns go through a single shared
+    copy of the calling sequence, written at the end of the output, and
+    if sharedCompares is set, so do eq, lt and gt.
+    If sourceMap is set, the output carries source map marks (see CodeWriter).
+    If fold is set, constant arithmetic and multiplication by constants are
+    evaluated at translation time (see vm_optimizer.fold).
+    If inline is set, calls to small leaf functions anywhere in the target
+    are replaced by their bodies (see vm_optimizer.inline).
+    If prune is set (in directory mode only), functions that can never be
+    called from Sys.init are left out; the CodeWriter's removed lists them.
+    If cacheTop is set, the stack top is kept in D where possible (see CodeWriter).
+    Raises RuntimeError if the program has more static variables than fit
+    in RAM. Returns the CodeWriter used, whose peepholeStats report the
+    savings and romWords and labels the size of the output.
     """
     if os.path.isdir(target):
-        outFile = os.path.join(target,
-                               os.path.basename(os.path.dirname(target)) + ".asm")
-        codeWriter = CodeWriter(outFile)
+        target = os.path.normpath(target)
+        if outFile is None:
+            outFile = os.path.join(target, os.path.basename(os.path.abspath(target)) + ".asm")
+        files = sorted(os.path.join(target, file) for file in os.listdir(target)
+                       if os.path.splitext(file)[1] == ".vm")
+        parsers = {}
+        leaves = keep = None
+        if inline or prune:
+            # whole program: the functions to inline, or called, may be in any file
+            import vm_optimizer
+            parsers = {file: Parser(file) for file in files}
+            program = [(os.path.basename(file), parsers[file].commands) for file in files]
+            if inline:
+                leaves = vm_optimizer.leaves(program)
+            if prune:
+                keep = _reachable(program, bootstrap, leaves)
+                removed = [name for file, commands in program
+                           for name in vm_optimizer.functions(commands)
+                           if keep is not None and name not in keep]
+        codeWriter = CodeWriter(outFile, optimize=optimize, sharedCalls=sharedCalls,
+                                sharedCompares=sharedCompares, sourceMap=sourceMap, fold=fold,
+                                inline=leaves, keep=keep, cacheTop=cacheTop)
+        if keep is not None:
+            codeWriter.removed = removed
         if bootstrap: codeWriter.writeInit()
 
-        for file in os.listdir(target):
-            if os.path.splitext(file)[1] == ".vm":
-                file = os.path.join(target, file)
-                parser = Parser(file)
+        for file in files:
+            if cache:
+                text, inlineStats, foldStats, statics = _cachedTranslation(
+                    file, os.path.join(target, ".vmcache"), sharedCalls, sharedCompares,
+                    sourceMap, fold, leaves, keep, cacheTop)
+                codeWriter.writeAssembly(text)
+                _addStats(codeWriter.inlineStats, inlineStats)
+                _addStats(codeWriter.foldStats, foldStats)
+                codeWriter.statics.update(statics)
+            else:
+                parser = parsers.get(file) or Parser(file)
                 codeWriter.setFileName(os.path.basename(file))
                 _compile(parser, codeWriter)
 
-        if bootstrap: codeWriter.close()
+        codeWriter.writeSharedRoutines()
+        codeWriter.close()
+        _checkStatics(codeWriter, target)
+        return codeWriter
 
     else:
-        outFile = os.path.splitext(target)[0] + ".asm"
+        if outFile is None:
+            outFile = os.path.splitext(target)[0] + ".asm"
         if outFile == target:
             # We only enforce that the file cannot end in ".asm,"
             # because by opening our output file we would erase the input.
             print("Cannot compile files ending in '.asm'")
             exit(1)
 
-        codeWriter = CodeWriter(outFile)
-        if bootstrap: codeWriter.writeInit()  # write bootstrap code needed to load OS
         parser = Parser(target)
+        leaves = None
+        if inline:
+            import vm_optimizer
+            leaves = vm_optimizer.leaves([(os.path.basename(target), parser.commands)])
+        codeWriter = CodeWriter(outFile, optimize=optimize, sharedCalls=sharedCalls,
+                                sharedCompares=sharedCompares, sourceMap=sourceMap, fold=fold,
+                                inline=leaves, cacheTop=cacheTop)
+        if bootstrap: codeWriter.writeInit()  # write bootstrap code needed to load OS
         codeWriter.setFileName(os.path.basename(target))
         _compile(parser, codeWriter)
+        codeWriter.writeSharedRoutines()
         codeWriter.close()
+        _checkStatics(codeWriter, target)
+        return codeWriter
 
 
 def main():
     parser = argparse.ArgumentParser(description='Translates VM bytecode to assembly')
     parser.add_argument("files", nargs="+")
     parser.add_argument("-b", help="Add bootstrap code", action="store_true")
+    parser.add_argument("-c", help="Cache translated files (directory mode)", action="store_true")
+    parser.add_argument("-O", help="Run the peephole optimizer and report its savings", action="store_true")
+    parser.add_argument("-s", help="Share one copy of the call and return code (smaller, slower)",
+                        action="store_true")
+    parser.add_argument("-e", help="Share one copy of each comparison (eq, lt, gt)", action="store_true")
+    parser.add_argument("-r", help="Report ROM size and label count with and without -s and -e",
+                        action="store_true")
+    parser.add_argument("-m", help="Mark the code of every VM command, for a source map",
+                        action="store_true")
+    parser.add_argument("-F", help="Fold constants and multiplications by constants, and report it",
+                        action="store_true")
+    parser.add_argument("-i", help="Inline calls to small leaf functions, and report it",
+                        action="store_true")
+    parser.add_argument("-D", help="Leave out functions never called from Sys.init (directory mode), "
+                        "and report it", action="store_true")
+    parser.add_argument("-T", help="Keep the top of the stack in D between commands", action="store_true")
     args = parser.parse_args()
     targets = args.files
     if len(targets) == 0:
         parser.print_help()
         exit(1)
     for target in targets:
-        compile(target, args.b)
+        try:
+            codeWriter = compile(target, args.b, args.c, optimize=args.O,
+                                 sharedCalls=args.s, sharedCompares=args.e, sourceMap=args.m,
+                                 fold=args.F, inline=args.i, prune=args.D, cacheTop=args.T)
+            if args.D:
+                # translate again with every function, only to measure it
+                whole = compile(target, args.b, args.c, io.StringIO(), args.O, args.s, args.e,
+                                fold=args.F, inline=args.i, cacheTop=args.T)
+            if args.r:
+                # translate again in every mode, only to measure them
+                sizes = [compile(target, args.b, args.c, io.StringIO(), args.O, calls, compares,
+                                 fold=args.F, inline=args.i, prune=args.D, cacheTop=args.T)
+                         for calls in (False, True) for compares in (False, True)]
+        except RuntimeError as err:
+            print(err.args[0], file=sys.stderr)
+            exit(1)
+        if args.r:
+            print("%s: code size" % target, file=sys.stderr)
+            for size in sizes:
+                print("  %-6s calls, %-6s compares %7d ROM words %6d labels%s" %
+                      ("shared" if size.sharedCalls else "inline",
+                       "shared" if size.sharedCompares else "inline",
+                       size.romWords, size.labels,
+                       " (this build)" if (size.sharedCalls, size.sharedCompares) ==
+                       (args.s, args.e) else ""), file=sys.stderr)
+        if args.D:
+            print("%s: left out %d functions, %d of %d ROM words (%.1f%%)" %
+                  (target, len(codeWriter.removed), whole.romWords - codeWriter.romWords,
+                   whole.romWords, 100.0 * (whole.romWords - codeWriter.romWords) /
+                   max(whole.romWords, 1)), file=sys.stderr)
+        if args.i:
+            import vm_optimizer
+            print("%s: inlining" % target, file=sys.stderr)
+            for line in vm_optimizer.report(codeWriter.inlineStats):
+                print("  " + line, file=sys.stderr)
+        if args.F:
+            import vm_optimizer
+            print("%s: constant folding" % target, file=sys.stderr)
+            for line in vm_optimizer.report(codeWriter.foldStats):
+                print("  " + line, file=sys.stderr)
+        if args.O:
+            print("%s: peephole optimizer" % target, file=sys.stderr)
+            for line in peephole.report(codeWriter.peepholeStats):
+                print("  " + line, file=sys.stderr)
     exit(0)
 
 if __name__ == '__main__':
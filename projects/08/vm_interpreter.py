@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+# executes VM code directly, without translating it to Hack
+#
+# Commands are parsed by vm_compiler.Parser and resolved once into a flat
+# list of (op, x, y) triples: labels and functions become command indices,
+# and every segment access becomes either a fixed RAM address (constant,
+# temp, pointer, static) or a pointer register plus offset.
+#
+# RAM is laid out exactly as in the translated program: SP, LCL, ARG,
+# THIS and THAT in RAM[0..4], temp in RAM[5..12], statics from RAM[16] in
+# order of first use (as the assembler allocates them), the stack from
+# 256, and the heap, screen and keyboard above. Calls push the same five
+# word frame as the translated code, so Memory.peek and Memory.poke see
+# the same memory, but return addresses are command indices, kept on a
+# Python call stack that also gives the backtrace for errors.
+# SP itself is kept in a local while running, and written to RAM[0] on
+# every call and return, and when run() stops.
+#
+# The "step" engine dispatches on one command at a time; the "blocks"
+# engine (the default) compiles each run of commands between jumps into a
+# Python function the first time it is reached, as hack_machine.py does
+# for Hack code. Both agree on every register and RAM word below SP.
+import os
+import sys
+import argparse
+from array import array
+
+import vm_compiler
+from vm_compiler import (C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO,
+                         C_IF, C_FUNCTION, C_RETURN, C_CALL)
+
+RAM_SIZE = 32768
+
+# resolved operations, roughly in order of how often they run
+(_PUSH_SEGMENT, _PUSH_CONSTANT, _PUSH_FIXED, _POP_SEGMENT, _POP_FIXED,
+ _ADD, _SUB, _IF, _GOTO, _EQ, _LT, _GT, _NOT, _AND, _OR, _NEG,
+ _CALL, _FUNCTION, _RETURN) = range(19)
+
+_arithmetic = {"add": _ADD, "sub": _SUB, "neg": _NEG, "eq": _EQ, "gt": _GT,
+               "lt": _LT, "and": _AND, "or": _OR, "not": _NOT}
+# expressions for operations in compiled blocks (gt needs a temporary)
+_binary = {_ADD: "((%s + %s) & 0xffff)", _SUB: "((%s - %s) & 0xffff)",
+           _EQ: "(0xffff if %s == %s else 0)", _LT: "(0xffff if (%s - %s) & 0x8000 else 0)",
+           _AND: "(%s & %s)", _OR: "(%s | %s)"}
+_unary = {_NOT: "(%s ^ 0xffff)", _NEG: "(-%s & 0xffff)"}
+
+_pointers = {"local": 1, "argument": 2, "this": 3, "that": 4}
+_fixed = {"pointer": 3, "temp": 5}
+
+
+def _vm_files(target):
+    if os.path.isdir(target):
+        return sorted(os.path.join(target, file) for file in os.listdir(target)
+                      if os.path.splitext(file)[1] == ".vm")
+    return [target]
+
+
+class VMInterpreter():
+    def __init__(self, target):
+        """target is a .vm file, or a directory whose .vm files make up the
+        program. The program starts at Sys.init, as after the bootstrap
+        code, if it has one, and at its first command otherwise."""
+        self.code = []       # (op, x, y) per command
+        self.origin = []     # (file, line, function) per command, for errors
+        self.functions = {}  # function name -> index of its function command
+        self.statics = {}    # static variable (File.vm.N) -> RAM address
+        labels = {}          # function-qualified label -> command index
+        targets = []         # (command index, label or function, is a call)
+        for file in _vm_files(target):
+            name = os.path.basename(file)
+            function = ""
+            for command in vm_compiler.Parser(file).commands:
+                try:
+                    function = self._resolve(command, name, function, labels, targets)
+                except RuntimeError as err:
+                    raise RuntimeError("%s: Line %d:\n\t%s" % (file, command.line, err.args[0]))
+                if command.type != C_LABEL:
+                    self.origin.append((file, command.line, function))
+
+        for index, label, isCall in targets:
+            resolved = self.functions if isCall else labels
+            if label not in resolved:
+                file, line, _ = self.origin[index]
+                raise RuntimeError("%s: Line %d:\n\tunknown %s %s" %
+                                   (file, line, "function" if isCall else "label", label))
+            op, _, y = self.code[index]
+            self.code[index] = (op, resolved[label], y)
+
+        # commands that can be jumped to, where compiled blocks must start
+        self._leaders = set(self.functions.values())
+        for index, (op, x, y) in enumerate(self.code):
+            if op in (_GOTO, _IF):
+                self._leaders.add(x)
+            if op == _CALL:
+                self._leaders.add(index + 1)
+        self._blocks = {}  # command index -> compiled block, see _compileBlock
+
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.reset()
+
+
+    def _resolve(self, command, name, function, labels, targets):
+        """Appends the operation for command to code, returning the name of
+        the function the next command is in."""
+        code = self.code
+        c_type, arg1, arg2 = command.type, command.arg1, command.arg2
+        if c_type == C_ARITHMETIC:
+            code.append((_arithmetic[arg1], None, None))
+        elif c_type in (C_PUSH, C_POP):
+            push = c_type == C_PUSH
+            if arg1 == "constant":
+                if not push:
+                    raise RuntimeError("cannot pop to constant")
+                if arg2 > 32767:
+                    raise RuntimeError("constant %d out of range" % arg2)
+                code.append((_PUSH_CONSTANT, arg2, None))
+            elif arg1 in _pointers:
+                code.append((_PUSH_SEGMENT if push else _POP_SEGMENT, _pointers[arg1], arg2))
+            else:
+                if arg1 == "static":
+                    static = "%s.%d" % (name, arg2)
+                    if static not in self.statics:
+                        self.statics[static] = 16 + len(self.statics)
+                    address = self.statics[static]
+                else:
+                    address = _fixed[arg1] + arg2
+                code.append((_PUSH_FIXED if push else _POP_FIXED, address, None))
+        elif c_type == C_LABEL:
+            label = function + "." + arg1
+            if label in labels:
+                raise RuntimeError("label %s already defined" % arg1)
+            labels[label] = len(code)
+        elif c_type in (C_GOTO, C_IF):
+            targets.append((len(code), function + "." + arg1, False))
+            code.append((_GOTO if c_type == C_GOTO else _IF, None, None))
+        elif c_type == C_FUNCTION:
+            if arg1 in self.functions:
+                raise RuntimeError("function %s already defined" % arg1)
+            self.functions[arg1] = len(code)
+            code.append((_FUNCTION, arg2, None))
+            return arg1
+        elif c_type == C_CALL:
+            targets.append((len(code), arg1, True))
+            code.append((_CALL, None, arg2))
+        elif c_type == C_RETURN:
+            code.append((_RETURN, None, None))
+        return function
+
+
+    def reset(self):
+        """Sets up the stack and enters Sys.init (if there is one), as the
+        bootstrap code does. RAM other than the stack pointer is left as is."""
+        self.calls = []  # return command index of each active call
+        self.steps = 0
+        self.ram[0] = 256
+        self.pc = 0
+        if "Sys.init" in self.functions:
+            # call Sys.init 0; returning from it ends the program
+            self.calls.append(len(self.code))
+            ram = self.ram
+            ram[256] = 0
+            ram[257:261] = ram[1:5]
+            ram[2] = 256
+            ram[0] = ram[1] = 261
+            self.pc = self.functions["Sys.init"]
+
+
+    def backtrace(self):
+        """Returns a line per active call, innermost first, naming the
+        function, file and line that is running."""
+        lines = []
+        pc = self.pc
+        for ret in reversed(self.calls + [len(self.code)]):
+            if pc < len(self.origin):
+                file, line, function = self.origin[pc]
+                lines.append("%s (%s, line %d)" % (function or "?", file, line))
+            if ret >= len(self.code):
+                break  # called by the bootstrap code
+            pc = ret - 1
+        return lines
+
+
+    def run(self, steps=None, until=None, engine="blocks"):
+        """Runs until steps commands have been executed, the function named
+        until is about to be entered (e.g. "Sys.halt"), or the program ends.
+        Returns the number of commands executed; the total is kept in
+        self.steps. engine is one of "blocks" or "step"."""
+        stop = -1 if until is None else self.functions[until]
+        return _engines[engine](self, steps, stop)
+
+
+    def _runBlocks(self, steps, stop):
+        blocks = self._blocks
+        get = blocks.get
+        calls = self.calls
+        ram = self.ram.tolist()
+        sp = ram[0]
+        pc = entry = self.pc
+        end = len(self.code)
+        n = 0
+        remaining = 0
+        try:
+            while pc != stop and pc < end:
+                block = get(pc)
+                if block is None:
+                    block = blocks[pc] = self._compileBlock(pc)
+                function, length = block
+                if steps is not None and n + length > steps:
+                    remaining = steps - n  # stepped through below
+                    break
+                entry = pc
+                sp, pc = function(ram, sp, calls)
+                n += length
+        except IndexError as err:
+            self.pc = entry
+            self.steps += n
+            self.ram[:] = array('H', ram)
+            raise RuntimeError("%s, in the block at\n\t%s" % (err, "\n\t".join(self.backtrace())))
+        ram[0] = sp
+        self.ram[:] = array('H', ram)
+        self.pc = pc
+        self.steps += n
+        if remaining:
+            n += self._runStep(remaining, stop)
+        return n
+
+
+    def _compileBlock(self, start):
+        """Compiles the commands from start up to the next jump, call or
+        return, or the next command that is a jump target, into a Python
+        function of (ram, sp, calls) that returns (sp, pc) after them.
+        Returns (function, number of commands).
+
+        Values pushed within a block are kept in Python expressions rather
+        than in RAM, until they are popped, or the block ends. Like the
+        peephole optimizer, this assumes no program reads the stack above
+        SP through a segment, which holds for all VM code that only uses
+        the stack through push and pop."""
+        code = self.code
+        lines = []
+        stack = []  # expressions of the values pushed but not yet in RAM
+        offset = 0  # of the top of the stack in RAM, from sp on entry
+        temps = 0
+
+        def address(x):
+            return "sp" if x == 0 else "sp %s %d" % ("+" if x > 0 else "-", abs(x))
+        def load(expr):
+            nonlocal temps
+            temps += 1
+            lines.append("t%d = %s" % (temps, expr))
+            return "t%d" % temps
+        def pop():
+            nonlocal offset
+            if stack:
+                return stack.pop()
+            offset -= 1
+            return load("ram[%s]" % address(offset))
+        def spill():
+            nonlocal offset
+            for value in stack:
+                lines.append("ram[%s] = %s" % (address(offset), value))
+                offset += 1
+            stack.clear()
+
+        pc = start
+        while True:
+            op, x, y = code[pc]
+            pc += 1
+            if op == _PUSH_SEGMENT:
+                stack.append(load("ram[ram[%d] + %d]" % (x, y)))
+            elif op == _PUSH_CONSTANT:
+                stack.append(str(x))
+            elif op == _PUSH_FIXED:
+                stack.append(load("ram[%d]" % x))
+            elif op == _POP_SEGMENT:
+                value = pop()
+                lines.append("ram[ram[%d] + %d] = %s" % (x, y, value))
+            elif op == _POP_FIXED:
+                value = pop()
+                lines.append("ram[%d] = %s" % (x, value))
+            elif op == _GT:
+                b = pop()
+                diff = load("(%s - %s) & 0xffff" % (pop(), b))
+                stack.append("(0xffff if 0 < %s < 0x8000 else 0)" % diff)
+            elif op in _binary:
+                b = pop()
+                stack.append(_binary[op] % (pop(), b))
+            elif op in _unary:
+                stack.append(_unary[op] % pop())
+            elif op == _FUNCTION:
+                spill()
+                if x:
+                    lines.append("ram[%s:%s] = %s" % (address(offset), address(offset + x), [0] * x))
+                    offset += x
+            else:
+                # control flow, which always ends the block
+                if op == _IF:
+                    value = pop()
+                    spill()
+                    lines.append("if %s: return %s, %d" % (value, address(offset), x))
+                    lines.append("return %s, %d" % (address(offset), pc))
+                elif op == _GOTO:
+                    spill()
+                    lines.append("return %s, %d" % (address(offset), x))
+                elif op == _CALL:
+                    spill()
+                    lines.extend(["calls.append(%d)" % pc,
+                                  "ram[%s] = %d" % (address(offset), pc & 0xffff),
+                                  "ram[%s:%s] = ram[1:5]" % (address(offset + 1), address(offset + 5)),
+                                  "ram[2] = %s" % address(offset - y),
+                                  "sp = %s" % address(offset + 5),
+                                  "ram[0] = ram[1] = sp",
+                                  "return sp, %d" % x])
+                else:
+                    value = pop()
+                    lines.extend(["frame = ram[1]",
+                                  "ram[ram[2]] = %s" % value,
+                                  "sp = ram[2] + 1",
+                                  "ram[0] = sp",
+                                  "ram[1:5] = ram[frame - 4:frame]",
+                                  "return sp, calls.pop()"])
+                break
+            if pc in self._leaders or pc == len(code):
+                spill()
+                lines.append("return %s, %d" % (address(offset), pc))
+                break
+
+        source = "def block(ram, sp, calls):\n    " + "\n    ".join(lines)
+        namespace = {}
+        exec(compile(source, "<%s, line %d>" % self.origin[start][:2], "exec"), namespace)
+        return namespace["block"], pc - start
+
+
+    def _runStep(self, steps, stop):
+        code = self.code
+        calls = self.calls
+        ram = self.ram.tolist()  # list items are quicker to get and set
+        sp = ram[0]
+        pc = self.pc
+        end = len(code)
+        limit = -1 if steps is None else steps
+        n = 0
+        try:
+            while pc != stop and pc < end and n != limit:
+                op, x, y = code[pc]
+                pc += 1
+                n += 1
+                if op == _PUSH_SEGMENT:
+                    ram[sp] = ram[ram[x] + y]
+                    sp += 1
+                elif op == _PUSH_CONSTANT:
+                    ram[sp] = x
+                    sp += 1
+                elif op == _PUSH_FIXED:
+                    ram[sp] = ram[x]
+                    sp += 1
+                elif op == _POP_SEGMENT:
+                    sp -= 1
+                    ram[ram[x] + y] = ram[sp]
+                elif op == _POP_FIXED:
+                    sp -= 1
+                    ram[x] = ram[sp]
+                elif op == _ADD:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xffff
+                elif op == _SUB:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xffff
+                elif op == _IF:
+                    sp -= 1
+                    if ram[sp]:
+                        pc = x
+                elif op == _GOTO:
+                    pc = x
+                elif op == _EQ:
+                    sp -= 1
+                    ram[sp - 1] = 0xffff if ram[sp - 1] == ram[sp] else 0
+                elif op == _LT:
+                    # as the translated code does: by the sign of x - y
+                    sp -= 1
+                    ram[sp - 1] = 0xffff if (ram[sp - 1] - ram[sp]) & 0x8000 else 0
+                elif op == _GT:
+                    sp -= 1
+                    diff = (ram[sp - 1] - ram[sp]) & 0xffff
+                    ram[sp - 1] = 0xffff if 0 < diff < 0x8000 else 0
+                elif op == _NOT:
+                    ram[sp - 1] ^= 0xffff
+                elif op == _AND:
+                    sp -= 1
+                    ram[sp - 1] &= ram[sp]
+                elif op == _OR:
+                    sp -= 1
+                    ram[sp - 1] |= ram[sp]
+                elif op == _NEG:
+                    ram[sp - 1] = -ram[sp - 1] & 0xffff
+                elif op == _CALL:
+                    calls.append(pc)
+                    ram[sp] = pc & 0xffff
+                    ram[sp + 1:sp + 5] = ram[1:5]
+                    ram[2] = sp - y
+                    sp += 5
+                    ram[0] = ram[1] = sp
+                    pc = x
+                elif op == _FUNCTION:
+                    ram[sp:sp + x] = [0] * x
+                    sp += x
+                elif op == _RETURN:
+                    frame = ram[1]
+                    ram[ram[2]] = ram[sp - 1]
+                    sp = ram[2] + 1
+                    ram[0] = sp
+                    ram[1:5] = ram[frame - 4:frame]
+                    pc = calls.pop()
+        except IndexError as err:
+            self.pc = pc - 1
+            self.steps += n - 1
+            self.ram[:] = array('H', ram)
+            raise RuntimeError("%s\n\t%s" % (err, "\n\t".join(self.backtrace())))
+        ram[0] = sp
+        self.ram[:] = array('H', ram)
+        self.pc = pc
+        self.steps += n
+        return n
+
+
+_engines = {
+    "blocks": VMInterpreter._runBlocks,
+    "step": VMInterpreter._runStep}
+
+
+def crossCheck(target, until="Sys.halt"):
+    """Runs the program at target both here and, translated and assembled,
+    on the Hack emulator, up to the entry to until. Returns a description
+    of every RAM word (outside the stack and scratch registers) that
+    differs, so an empty list means both agree."""
+    import io
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+    import assembler_regex
+    import hack_machine
+
+    vm = VMInterpreter(target)
+    vm.run(until=until)
+
+    out = io.StringIO()
+    vm_compiler.compile(target, bootstrap=True, outFile=out)
+    out.seek(0)
+    sym = assembler_regex._default_symbols()
+    words = assembler_regex._assemble_table(out, sym)
+    hack = hack_machine.HackMachine(words)
+    hack.run(until=sym[until])
+
+    differences = []
+    def compare(what, vmAddress, hackAddress):
+        if vm.ram[vmAddress] != hack.ram[hackAddress]:
+            differences.append("%s: %d here, %d on the Hack emulator" %
+                               (what, vm.ram[vmAddress], hack.ram[hackAddress]))
+    for address in range(13):
+        compare("RAM[%d]" % address, address, address)
+    for static, address in sorted(vm.statics.items()):
+        compare(static, address, sym[static])
+    for address in range(2048, hack_machine.KBD + 1):
+        compare("RAM[%d]" % address, address, address)
+    return differences
+
+
+def main():
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description='Runs VM code directly')
+    parser.add_argument("target", help=".vm file, or directory of .vm files")
+    parser.add_argument("-n", help="Stop after N commands", metavar="N", type=int)
+    parser.add_argument("-u", help="Stop on entering this function (default: Sys.halt, if defined)",
+                        metavar="FUNCTION")
+    parser.add_argument("-d", help="Print RAM[START..END) when done", metavar="START:END")
+    parser.add_argument("-e", help="Execution engine to use", choices=_engines, default="blocks")
+    parser.add_argument("-x", help="Cross-check RAM against the translated program on the Hack emulator",
+                        action="store_true")
+    args = parser.parse_args()
+    try:
+        vm = VMInterpreter(args.target)
+        until = args.u
+        if until is None and "Sys.halt" in vm.functions:
+            until = "Sys.halt"
+        if until is not None and until not in vm.functions:
+            raise RuntimeError("unknown function %s" % until)
+        start = perf_counter()
+        vm.run(args.n, until, args.e)
+        elapsed = perf_counter() - start
+        print("%d commands in %0.3fs (%0.0f/s)" %
+              (vm.steps, elapsed, vm.steps / max(elapsed, 1e-9)), file=sys.stderr)
+        if args.d:
+            first, last = (int(x) for x in args.d.split(":"))
+            for address in range(first, last):
+                print("RAM[%d] = %d" % (address, vm.ram[address]))
+        if args.x:
+            if until is None:
+                raise RuntimeError("cross-checking needs a function to stop at (-u)")
+            differences = crossCheck(args.target, until)
+            for difference in differences:
+                print(difference, file=sys.stderr)
+            print("cross-check: %s" % ("%d differences" % len(differences) if differences else "ok"),
+                  file=sys.stderr)
+            if differences:
+                exit(1)
+    except RuntimeError as err:
+        print(err.args[0], file=sys.stderr)
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+# optimizations of VM code, from parsed Commands to Commands
+#
+# fold() evaluates what it can at translation time, for the naive stack code
+# the Jack compiler emits: arithmetic on constants (including calls to
+# Math.multiply and Math.divide), branches on constants, pairs of commands
+# that cancel out, and multiplication by a small constant, which becomes a
+# sequence of additions instead of a call to Math.multiply.
+#
+# Results are computed exactly as the translated code computes them:
+# 16-bit two's complement, with lt and gt on the sign of the difference.
+# Constants are kept as "push constant" with any 16-bit value while folding,
+# and only written out in a form the VM accepts (0..32767) at the end.
+#
+# Multiplication sequences keep values in temp 6 and temp 7, which the Jack
+# compiler never uses (it only uses temp 0, within a single statement); VM
+# code that keeps values there across a multiplication must not be folded.
+#
+# inline() replaces calls to small leaf functions, as found by leaves() in
+# the whole program, with their bodies. Arguments and locals move to temp 1
+# to temp 5, statics keep referring to the callee's file, and labels are
+# renamed apart. Unlike a call, inlined code does not save and restore THAT,
+# which is fine for Jack code (it sets pointer 1 right before every use of
+# that), and leaves that set pointer 0 are never inlined.
+#
+# reachable() finds the functions a program can ever call, from Sys.init,
+# so that the rest can be left out of the translation.
+
+from vm_compiler import (Command, C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF,
+                         C_FUNCTION, C_RETURN, C_CALL)
+
+
+# names of the rewrites, for reporting
+CONSTANT = "constant arithmetic"
+CONSTANT_CALL = "constant multiply/divide"
+MULTIPLY = "multiply by constant"
+IDENTITY = "identity operation"
+PAIR = "not/not, neg/neg pair"
+BRANCH = "branch on constant"
+INLINE = "inlined call"
+
+MULTIPLY_CALL = "Math.multiply"
+DIVIDE_CALL = "Math.divide"
+
+_MAX_FACTOR = 255  # larger factors take more code than the call
+_X, _SCRATCH = 7, 6  # temp registers for multiplication sequences
+
+_binary = {"add": lambda x, y: x + y,
+           "sub": lambda x, y: x - y,
+           "and": lambda x, y: x & y,
+           "or": lambda x, y: x | y,
+           "eq": lambda x, y: -1 if x == y else 0,
+           "lt": lambda x, y: -1 if (x - y) & 0x8000 else 0,
+           "gt": lambda x, y: -1 if 0 < (x - y) & 0xffff < 0x8000 else 0}
+_unary = {"neg": lambda x: -x, "not": lambda x: ~x}
+
+# operations that leave x unchanged when y is the constant given
+_identities = {"add": 0, "sub": 0, "or": 0, "and": 0xffff}
+
+
+def _count(stats, rewrite, saved):
+    sites, total = stats.get(rewrite, (0, 0))
+    stats[rewrite] = (sites + 1, total + saved)
+
+
+def _constant(command):
+    """Returns the value pushed by command if it pushes a constant, else None."""
+    if command.type == C_PUSH and command.arg1 == "constant":
+        return command.arg2
+    return None
+
+
+def _push(value, line):
+    return Command(C_PUSH, "constant", value & 0xffff, line)
+
+
+def _signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def _divide(x, y):
+    """Math.divide, for the values it handles: the quotient rounded
+    towards zero. Returns None where it would fail or not terminate."""
+    x, y = _signed(x), _signed(y)
+    if y == 0 or x == -0x8000 or y == -0x8000:
+        return None
+    quotient = abs(x) // abs(y)
+    return -quotient if (x < 0) != (y < 0) else quotient
+
+
+def _effect(command):
+    """Returns (values popped, values pushed) for commands that do not
+    change the flow of control, else None."""
+    if command.type == C_PUSH:
+        return 0, 1
+    if command.type == C_POP:
+        return 1, 0
+    if command.type == C_ARITHMETIC:
+        return (1, 1) if command.arg1 in _unary else (2, 1)
+    if command.type == C_CALL:
+        return command.arg2, 1
+    return None
+
+
+def _operand(out):
+    """Returns the index in out where the code of the value on top of the
+    stack begins, if it is straight-line code that reads nothing pushed
+    before it, else None."""
+    need = 1
+    i = len(out)
+    while i > 0:
+        i -= 1
+        effect = _effect(out[i])
+        if effect is None:
+            return None
+        need += effect[0] - effect[1]
+        if need == 0:
+            return i
+    return None
+
+
+def _reusable(command):
+    """Returns whether command is a push that can be repeated to get the
+    same value again, while multiplying."""
+    return (command.type == C_PUSH and
+            not (command.arg1 == "temp" and command.arg2 in (_X, _SCRATCH)))
+
+
+def _multiply(out, factor, line):
+    """Multiplies the value on top of the stack by factor (0..0xffff), with
+    additions. Returns False, leaving out as is, if the factor is too large."""
+    negate = factor & 0x8000
+    if negate:
+        factor = -factor & 0xffff
+    if factor > _MAX_FACTOR:
+        return False
+    start = _operand(out)
+    single = start == len(out) - 1 and _reusable(out[start])
+    if factor == 0:
+        if single:
+            out.pop()
+        else:
+            out.append(Command(C_POP, "temp", _SCRATCH, line))
+        out.append(_push(0, line))
+        return True
+    if single:
+        x = out[-1]
+    else:
+        x = Command(C_PUSH, "temp", _X, line)
+        if factor & (factor - 1):  # x is needed after the first doubling
+            out.extend([Command(C_POP, "temp", _X, line), x])
+    bits = bin(factor)[3:]  # after the leading 1, which is x itself
+    for i, bit in enumerate(bits):
+        if i == 0 and (single or factor & (factor - 1)):
+            out.extend([x, Command(C_ARITHMETIC, "add", None, line)])
+        else:
+            out.extend([Command(C_POP, "temp", _SCRATCH, line),
+                        Command(C_PUSH, "temp", _SCRATCH, line),
+                        Command(C_PUSH, "temp", _SCRATCH, line),
+                        Command(C_ARITHMETIC, "add", None, line)])
+        if bit == "1":
+            out.extend([x, Command(C_ARITHMETIC, "add", None, line)])
+    if negate:
+        out.append(Command(C_ARITHMETIC, "neg", None, line))
+    return True
+
+
+def _writeConstants(commands):
+    """Replaces pushes of constants outside 0..32767 with commands that
+    compute them."""
+    out = []
+    for command in commands:
+        value = _constant(command)
+        if value is None or value < 0x8000:
+            out.append(command)
+        elif value == 0x8000:
+            out.extend([Command(C_PUSH, "constant", 0x7fff, command.line),
+                        Command(C_ARITHMETIC, "not", None, command.line)])
+        else:
+            out.extend([Command(C_PUSH, "constant", 0x10000 - value, command.line),
+                        Command(C_ARITHMETIC, "neg", None, command.line)])
+    return out
+
+
+def fold(commands, stats=None):
+    """Returns an optimized copy of the list of Commands of a VM file. For
+    every rewrite applied, stats (if given) maps its name to (sites, VM
+    commands saved), and the names of the functions whose calls were
+    removed (MULTIPLY_CALL, DIVIDE_CALL) to the number of call sites."""
+    if stats is None:
+        stats = {}
+    out = []
+    for command in commands:
+        c_type = command.type
+        line = command.line
+        if c_type == C_ARITHMETIC:
+            op = command.arg1
+            y = _constant(out[-1]) if out else None
+            if op in _unary:
+                if y is not None:
+                    out[-1] = _push(_unary[op](y), line)
+                    _count(stats, CONSTANT, 1)
+                    continue
+                if out and out[-1].type == C_ARITHMETIC and out[-1].arg1 == op:
+                    out.pop()
+                    _count(stats, PAIR, 2)
+                    continue
+            else:
+                x = _constant(out[-2]) if len(out) > 1 else None
+                if x is not None and y is not None:
+                    out[-2:] = [_push(_binary[op](x, y), line)]
+                    _count(stats, CONSTANT, 2)
+                    continue
+                if y is not None and _identities.get(op) == y:
+                    out.pop()
+                    _count(stats, IDENTITY, 2)
+                    continue
+        elif c_type == C_CALL and command.arg2 == 2 and command.arg1 in (MULTIPLY_CALL, DIVIDE_CALL):
+            y = _constant(out[-1]) if out else None
+            x = _constant(out[-2]) if len(out) > 1 else None
+            if x is not None and y is not None:
+                if command.arg1 == MULTIPLY_CALL:
+                    value = x * y
+                else:
+                    value = _divide(x, y)
+                if value is not None:
+                    out[-2:] = [_push(value, line)]
+                    _count(stats, CONSTANT_CALL, 2)
+                    _count(stats, command.arg1, 0)
+                    continue
+            if command.arg1 == MULTIPLY_CALL:
+                if y is None:
+                    start = _operand(out)
+                    x = _constant(out[start - 1]) if start else None
+                    if x is not None:
+                        # commutes, so the constant can go on top
+                        out.append(out.pop(start - 1))
+                        y = x
+                if y is not None:
+                    size = len(out)
+                    factor = out.pop().arg2
+                    if _multiply(out, factor, line):
+                        _count(stats, MULTIPLY, size + 1 - len(out))
+                        _count(stats, MULTIPLY_CALL, 0)
+                        continue
+                    out.append(_push(factor, line))
+            elif y == 1:
+                out.pop()  # x / 1
+                _count(stats, IDENTITY, 2)
+                _count(stats, DIVIDE_CALL, 0)
+                continue
+        elif c_type == C_IF and out:
+            y = _constant(out[-1])
+            if y is not None:
+                out.pop()
+                if y:
+                    out.append(Command(C_GOTO, command.arg1, None, line))
+                    _count(stats, BRANCH, 1)
+                else:
+                    _count(stats, BRANCH, 2)
+                continue
+        out.append(command)
+    return _writeConstants(out)
+
+
+_MAX_INLINE = 16  # commands in the body of a function to inline
+_SLOTS = range(1, 6)  # temp registers for the arguments and locals of inlined code
+_commutative = {"add", "and", "or", "eq"}
+
+
+class Leaf():
+    """A function that can be inlined: file is the .vm file it is defined
+    in, locals its number of locals, and body its commands."""
+    def __init__(self, file, locals, body):
+        self.file = file
+        self.locals = locals
+        self.body = body
+
+
+def _inlinable(body):
+    """Returns whether body, the commands of a function after its
+    "function" command, can be inlined: it is short, calls nothing, has no
+    loops, keeps THIS as it is, and has nothing but its result on the stack
+    when it returns (and nothing at labels and jumps), as Jack code has."""
+    if len(body) > _MAX_INLINE or not body or body[-1].type not in (C_RETURN, C_LABEL):
+        return False
+    depth = 0
+    labels = set()
+    for command in body:
+        c_type = command.type
+        if c_type in (C_CALL, C_FUNCTION):
+            return False
+        if c_type in (C_GOTO, C_IF) and command.arg1 in labels:
+            return False  # a loop
+        if c_type == C_POP and command.arg1 == "pointer" and command.arg2 == 0:
+            return False
+        if c_type == C_LABEL:
+            if depth not in (0, None):
+                return False
+            depth = 0
+            labels.add(command.arg1)
+        elif c_type == C_RETURN:
+            if depth != 1:
+                return False
+            depth = None  # unreachable until the next label
+        elif depth is not None:
+            effect = _effect(command)
+            if effect:
+                depth -= effect[0]
+                if depth < 0:
+                    return False
+                depth += effect[1]
+            else:
+                depth -= 1 if c_type == C_IF else 0
+                if depth != 0:
+                    return False
+                if c_type == C_GOTO:
+                    depth = None
+    return True
+
+
+def functions(commands):
+    """Returns a dict from the name of each function defined in commands
+    to the range of its commands (the "function" command included)."""
+    starts = [i for i, command in enumerate(commands) if command.type == C_FUNCTION]
+    return {commands[start].arg1: range(start, end)
+            for start, end in zip(starts, starts[1:] + [len(commands)])}
+
+
+def leaves(files):
+    """Returns the functions of a program that inline() may inline, as a
+    dict from name to Leaf. files is a list of (.vm file name, Commands)
+    for every file in the program."""
+    found = {}
+    for file, commands in files:
+        for name, lines in functions(commands).items():
+            body = commands[lines.start + 1:lines.stop]
+            locals = commands[lines.start].arg2
+            if _inlinable(body) and locals < len(_SLOTS):
+                found[name] = Leaf(file, locals, body)
+    return found
+
+
+def signature(leaves):
+    """Returns bytes that identify leaves, e.g. to key cached translations."""
+    return repr(sorted((name, leaf.file, leaf.locals,
+                        [(c.type, c.arg1, c.arg2) for c in leaf.body])
+                       for name, leaf in leaves.items())).encode()
+
+
+def _bind(leaf, args, call, count):
+    """Returns the body of leaf, to run in place of call (with args
+    arguments), and the temp registers that hold a value read only once."""
+    slots = {("argument", i): _SLOTS[i] for i in range(args)}
+    slots.update((("local", i), _SLOTS[args + i]) for i in range(leaf.locals))
+    reads = {}
+    for command in leaf.body:
+        key = (command.arg1, command.arg2)
+        if key in slots:
+            reads[key] = reads.get(key, 0) + (1 if command.type == C_PUSH else 2)
+    once = {slots[key] for key, count in reads.items() if count == 1}
+    line = call.line
+    prefix = "%s$inline.%d." % (call.arg1, count)
+    end = prefix + "RETURN"
+    out = [Command(C_POP, "temp", _SLOTS[i], line) for i in reversed(range(args))]
+    for i in range(leaf.locals):
+        out.extend([Command(C_PUSH, "constant", 0, line),
+                    Command(C_POP, "temp", _SLOTS[args + i], line)])
+    returns = False
+    for i, command in enumerate(leaf.body):
+        c_type = command.type
+        if c_type in (C_PUSH, C_POP):
+            key = (command.arg1, command.arg2)
+            if key in slots:
+                out.append(Command(c_type, "temp", slots[key], line))
+            elif command.arg1 == "static":
+                out.append(Command(c_type, "static", command.arg2, line, leaf.file))
+            else:
+                out.append(Command(c_type, command.arg1, command.arg2, line))
+        elif c_type in (C_LABEL, C_GOTO, C_IF):
+            out.append(Command(c_type, prefix + command.arg1, None, line))
+        elif c_type == C_RETURN:
+            if i < len(leaf.body) - 1:
+                out.append(Command(C_GOTO, end, None, line))
+                returns = True
+        else:
+            out.append(Command(c_type, command.arg1, command.arg2, line))
+    if returns:
+        out.append(Command(C_LABEL, end, None, line))
+    return out, once
+
+
+def _unbind(body, once):
+    """Takes out the temp registers of values read only once where their
+    value can be left on the stack: right before it is read, or before a
+    single push and a commutative operation."""
+    out = []
+    for command in body:
+        if command.type == C_PUSH and command.arg1 == "temp" and command.arg2 in once:
+            last = out[-1] if out else None
+            if last and last.type == C_POP and last.arg1 == "temp" and last.arg2 == command.arg2:
+                out.pop()  # pop temp k, push temp k
+                continue
+        elif (command.type == C_ARITHMETIC and command.arg1 in _commutative and len(out) > 2 and
+                out[-1].type == C_PUSH and out[-1].arg1 == "temp" and out[-1].arg2 in once and
+                out[-2].type == C_PUSH and out[-2].arg1 != "temp" and
+                out[-3].type == C_POP and out[-3].arg1 == "temp" and
+                out[-3].arg2 == out[-1].arg2):
+            # pop temp k, push x, push temp k, op: op(value, x) is op(x, value)
+            out[-3:] = [out[-2]]
+        out.append(command)
+    return out
+
+
+def _inlined(call, leaves):
+    """Returns the Leaf that inline() puts in place of call, or None if it
+    keeps the call."""
+    leaf = leaves.get(call.arg1)
+    if leaf is None or call.arg2 + leaf.locals > len(_SLOTS) or any(
+            c.arg1 == "argument" and c.arg2 >= call.arg2 for c in leaf.body):
+        return None
+    return leaf
+
+
+def inline(commands, leaves, stats=None):
+    """Returns a copy of the list of Commands of a VM file, with the calls
+    to the functions in leaves (as returned by leaves()) replaced by their
+    bodies. stats (if given) counts the INLINE sites, with the VM commands
+    saved, and the call sites removed for each function."""
+    if stats is None:
+        stats = {}
+    out = []
+    count = 0
+    for command in commands:
+        leaf = _inlined(command, leaves) if command.type == C_CALL else None
+        if leaf is None:
+            out.append(command)
+            continue
+        count += 1
+        body, once = _bind(leaf, command.arg2, command, count)
+        body = _unbind(body, once)
+        out.extend(body)
+        _count(stats, INLINE, 1 - len(body))
+        _count(stats, command.arg1, 0)
+    return out
+
+
+def reachable(files, roots=("Sys.init",), leaves=None):
+    """Returns the set of functions that can be called, directly or not,
+    from the functions in roots. files is a list of (.vm file name,
+    Commands) for every file in the program. Calls that inline() replaces
+    with leaves (if given) do not count, as the translation has none."""
+    calls = {}  # function -> functions it calls
+    for file, commands in files:
+        for function, lines in functions(commands).items():
+            calls[function] = {command.arg1 for command in (commands[i] for i in lines)
+                               if command.type == C_CALL and
+                               not (leaves and _inlined(command, leaves))}
+    found = set()
+    pending = [root for root in roots if root in calls]
+    while pending:
+        function = pending.pop()
+        if function not in found:
+            found.add(function)
+            pending.extend(callee for callee in calls.get(function, ()) if callee not in found)
+    return found
+
+
+def report(stats):
+    """Returns a line per rewrite describing how much it saved, and a line
+    per function with the number of call sites removed."""
+    lines = []
+    for rewrite, (sites, saved) in sorted(stats.items()):
+        if "." in rewrite:  # a function
+            lines.append("%-26s %7d call sites removed" % (rewrite, sites))
+        else:
+            lines.append("%-26s %7d sites %8d commands saved" % (rewrite, sites, saved))
+    return lines
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# profiles translated VM code on the Hack emulator, per VM function and command
+#
+# The program is translated with source map marks (see CodeWriter), which
+# the assembler turns into a map from ROM addresses to the VM file, line,
+# function and command their code came from. It then runs on the emulator's
+# "blocks" engine, with every function entry compiled as a block boundary,
+# so each block runs within a single function: a block starting at the
+# entry of a function, right after one that ended with the code of a call,
+# pushes it on a shadow call stack, and a block ending with the code of a
+# return pops it. (A loop at the top of a function jumps back to its entry
+# too, from code of its own.) The cycles of every block go to the
+# call stack it ran in, which gives inclusive and exclusive counts for each
+# function and folded stacks for flamegraph.pl; the ROM addresses each
+# block went through give the counts for each VM command.
+#
+# Counts are exact: they add up to the cycles the emulator ran. The cost of
+# a call is split between the caller, which runs the calling sequence up
+# to the jump, and the callee, which runs its own return.
+import io
+import os
+import sys
+import argparse
+from array import array
+
+import vm_compiler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06"))
+import assembler_regex
+import hack_machine
+
+
+def build(target, bootstrap=False, optimize=False, sharedCalls=False, sharedCompares=False,
+          fold=False, inline=False, cacheTop=False, prune=False):
+    """Translates and assembles target in memory, returning the ROM words,
+    the source map marks as (address, text) pairs, and the symbol table."""
+    out = io.StringIO()
+    vm_compiler.compile(target, bootstrap, outFile=out, optimize=optimize,
+                        sharedCalls=sharedCalls, sharedCompares=sharedCompares, sourceMap=True,
+                        fold=fold, inline=inline, cacheTop=cacheTop, prune=prune)
+    out.seek(0)
+    marks = []
+    sym = assembler_regex._default_symbols()
+    words = assembler_regex._assemble_table(out, sym, marks)
+    return [int(word, 2) for word in words], marks, sym
+
+
+class Profiler():
+    def __init__(self, words, marks):
+        """words is the program's ROM, and marks its source map, as returned
+        by build(). Counts accumulate over calls to run()."""
+        self.machine = hack_machine.HackMachine(words)
+        size = len(self.machine.rom)
+        self.commands = ["-"] * size   # ROM address -> VM command
+        self.functions = ["-"] * size  # ROM address -> VM function
+        self._entries = {}  # ROM address -> function entered there
+        marks = sorted(marks, key=lambda mark: mark[0])  # stable, so the last mark wins
+        for i, (address, text) in enumerate(marks):
+            _, _, function, command = text.split()
+            last = marks[i + 1][0] if i + 1 < len(marks) else size
+            self.commands[address:last] = [command] * (last - address)
+            self.functions[address:last] = [function] * (last - address)
+            if command == "function" and address < size:
+                self._entries[address] = function
+        self._returns = {address for address, command in enumerate(self.commands)
+                         if command == "return"}
+        # the bootstrap calls Sys.init with code of its own
+        self._callers = {address for address, command in enumerate(self.commands)
+                         if command in ("call", "bootstrap")}
+        self._blocks = {}
+        self._stops = None
+        # code run outside any call (the bootstrap) gets a frame of its own
+        self.stack = () if 0 in self._entries else (self._outside(),)
+        self._called = True  # whether the last block ran ended with a call
+        self.folded = {}  # call stack (tuple of functions) -> cycles spent in it
+        self.calls = {}   # function -> times called
+        self._passes = {} # block entry -> passes run, not yet in _commands
+        self._commands = {}  # VM command -> cycles
+
+
+    def _outside(self):
+        if not self.commands or self.functions[0] != "-":
+            return "(start)"
+        return "(%s)" % self.commands[0]
+
+
+    def run(self, cycles=None, until=None):
+        """Runs the program as HackMachine.run does, until the ROM address
+        until, the end of the program, or, if cycles is given, the last
+        block boundary before that many cycles. Returns the cycles run."""
+        machine = self.machine
+        stops = frozenset(self._entries) | (frozenset() if until is None else frozenset([until]))
+        if stops != self._stops:
+            self._countCommands()  # before the traces of the blocks go
+            self._blocks.clear()
+            self._stops = stops
+        blocks = self._blocks
+        rom = machine.rom
+        ram = machine.ram.tolist()
+        a, d, pc = machine.a, machine.d, machine.pc
+        end = len(rom)
+        stop = -1 if until is None else until
+        entries, returns, callers = self._entries, self._returns, self._callers
+        folded, calls, passesRun = self.folded, self.calls, self._passes
+        stack, called = self.stack, self._called
+        n = 0
+        entry = pc
+        try:
+            while pc < end and pc != stop:
+                block = blocks.get(pc)
+                if block is None:
+                    block = blocks[pc] = hack_machine._compile_block(rom, pc, stops)
+                function, length, halts, trace = block
+                if cycles is None:
+                    budget = -1
+                else:
+                    budget = (cycles - n) // length
+                    if budget == 0:
+                        break
+                if called and pc in entries:
+                    name = entries[pc]
+                    stack = stack + (name,)
+                    calls[name] = calls.get(name, 0) + 1
+                entry = pc
+                a, d, pc, passes = function(a, d, ram, budget)
+                n += passes * length
+                folded[stack] = folded.get(stack, 0) + passes * length
+                passesRun[entry] = passesRun.get(entry, 0) + passes
+                if trace[-1] in returns and len(stack) > 1:
+                    stack = stack[:-1]
+                called = trace[-1] in callers
+                if halts:
+                    break
+        except IndexError:
+            raise RuntimeError("ROM[%d]:\n\tRAM address out of range in block" % entry)
+        finally:
+            machine.ram[:] = array('H', ram)
+        machine.a, machine.d, machine.pc = a, d, pc
+        machine.cycles += n
+        self.stack, self._called = stack, called
+        return n
+
+
+    def inclusive(self):
+        """Returns the cycles spent in each function, including its callees
+        (recursive calls are counted once)."""
+        counts = {}
+        for stack, cycles in self.folded.items():
+            for function in set(stack):
+                counts[function] = counts.get(function, 0) + cycles
+        return counts
+
+
+    def exclusive(self):
+        """Returns the cycles spent in the code of each function itself."""
+        counts = {}
+        for stack, cycles in self.folded.items():
+            counts[stack[-1]] = counts.get(stack[-1], 0) + cycles
+        return counts
+
+
+    def _countCommands(self):
+        counts = self._commands
+        for entry, passes in self._passes.items():
+            for address in self._blocks[entry][3]:
+                command = self.commands[address]
+                counts[command] = counts.get(command, 0) + passes
+        self._passes.clear()
+
+
+    def commandCycles(self):
+        """Returns the cycles spent in the code of each type of VM command
+        ("push", "add", "call", ...)."""
+        self._countCommands()
+        return dict(self._commands)
+
+
+    def report(self, top=20):
+        """Returns the report lines: the top functions by exclusive cycles,
+        then every command type."""
+        total = self.machine.cycles or 1
+        inclusive, exclusive = self.inclusive(), self.exclusive()
+        lines = ["%d cycles, %d calls" % (self.machine.cycles, sum(self.calls.values())),
+                 "%-32s %8s %12s %6s %12s %6s" %
+                 ("function", "calls", "inclusive", "%", "exclusive", "%")]
+        ranked = sorted(exclusive, key=lambda function: (-exclusive[function], function))
+        for function in ranked[:top]:
+            lines.append("%-32s %8d %12d %5.1f%% %12d %5.1f%%" %
+                         (function, self.calls.get(function, 0),
+                          inclusive[function], 100.0 * inclusive[function] / total,
+                          exclusive[function], 100.0 * exclusive[function] / total))
+        lines.append("%-32s %12s %6s" % ("command", "cycles", "%"))
+        commands = self.commandCycles()
+        for command in sorted(commands, key=lambda command: (-commands[command], command)):
+            lines.append("%-32s %12d %5.1f%%" %
+                         (command, commands[command], 100.0 * commands[command] / total))
+        return lines
+
+
+    def writeFolded(self, outFile):
+        """Writes the cycles of every call stack in the folded format read
+        by flamegraph.pl: "Sys.init;Main.main;Math.multiply 1234"."""
+        with open(outFile, 'w') as f:
+            for stack, cycles in sorted(self.folded.items()):
+                if cycles:
+                    f.write("%s %d\n" % (";".join(stack), cycles))
+
+
+def main():
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description='Profiles translated VM code on the Hack emulator')
+    parser.add_argument("target", help=".vm file, or directory of .vm files")
+    parser.add_argument("-b", help="Add bootstrap code", action="store_true")
+    parser.add_argument("-O", help="Run the peephole optimizer", action="store_true")
+    parser.add_argument("-s", help="Share one copy of the call and return code", action="store_true")
+    parser.add_argument("-e", help="Share one copy of each comparison (eq, lt, gt)", action="store_true")
+    parser.add_argument("-F", help="Fold constants and multiplications by constants",
+                        action="store_true")
+    parser.add_argument("-i", help="Inline calls to small leaf functions", action="store_true")
+    parser.add_argument("-T", help="Keep the top of the stack in D between commands", action="store_true")
+    parser.add_argument("-D", help="Leave out functions never called from Sys.init", action="store_true")
+    parser.add_argument("-n", help="Stop after about N cycles", metavar="N", type=int)
+    parser.add_argument("-u", help="Stop on entering this function (default: Sys.halt, if defined)",
+                        metavar="FUNCTION")
+    parser.add_argument("-t", help="Report the top N functions (default: 20)", metavar="N",
+                        type=int, default=20)
+    parser.add_argument("-f", help="Write folded call stacks, for flamegraph.pl", metavar="FILE")
+    args = parser.parse_args()
+    try:
+        words, marks, sym = build(args.target, args.b, args.O, args.s, args.e, args.F, args.i,
+                                   args.T, args.D)
+        until = args.u
+        if until is None and "Sys.halt" in sym:
+            until = "Sys.halt"
+        if until is not None and until not in sym:
+            raise RuntimeError("unknown function %s" % until)
+        profiler = Profiler(words, marks)
+        start = perf_counter()
+        profiler.run(args.n, None if until is None else sym[until])
+        elapsed = perf_counter() - start
+        print("profiled in %0.3fs" % elapsed, file=sys.stderr)
+        for line in profiler.report(args.t):
+            print(line)
+        if args.f:
+            profiler.writeFolded(args.f)
+    except RuntimeError as err:
+        print(err.args[0], file=sys.stderr)
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# times the Jack compiler on generated classes of growing size, to check
+# that compile time grows linearly with the number of variables
+#
+# Each class declares n fields, n statics and, in a single method, n
+# locals, then assigns every local from a field, a static and the local
+# before it: n declarations of each kind and n statements, each of which
+# looks up four names.
+import sys
+import argparse
+import subprocess
+from time import perf_counter
+
+import jack_build
+
+
+def stress_class(n):
+    """Returns the source of a class with n fields, statics and locals, and
+    a method of n statements."""
+    def declare(indent, kind, prefix):
+        # ten names per declaration, so no line gets very long
+        return ["%s%s int %s;" % (indent, kind,
+                                  ", ".join("%s%d" % (prefix, j) for j in range(i, min(i + 10, n))))
+                for i in range(0, n, 10)]
+    lines = ["class Stress {"]
+    lines += declare("    ", "field", "f")
+    lines += declare("    ", "static", "s")
+    lines += ["    method int sum(int a) {"]
+    lines += declare("        ", "var", "v")
+    lines += ["        let v0 = a;"]
+    lines += ["        let v%d = v%d + f%d + s%d;" % (i, i - 1, i, i) for i in range(1, n)]
+    lines += ["        return v%d;" % (n - 1), "    }", "}", ""]
+    return "\n".join(lines)
+
+
+def time_compile(source, runs=3):
+    """Compiles source with the compiler, returning the best of runs wall
+    clock times, and the error the compiler reported, if any."""
+    best, error = None, None
+    for _ in range(runs):
+        start = perf_counter()
+        result = subprocess.run([jack_build.COMPILER], input=source.encode(), capture_output=True)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        if result.returncode != 0 or result.stderr:
+            error = result.stderr.decode(errors="replace").strip() or "exited with %d" % result.returncode
+            break
+    return best, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the Jack compiler on generated classes')
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 2000, 4000, 8000, 16000],
+                        help="numbers of variables of each kind (default: 1000 to 16000)")
+    parser.add_argument("-r", help="Time the best of N runs (default: 3)", metavar="N", type=int,
+                        default=3)
+    args = parser.parse_args()
+    try:
+        jack_build.build_compiler()
+    except RuntimeError as err:
+        print(err.args[0], file=sys.stderr)
+        exit(1)
+    for n in args.sizes:
+        elapsed, error = time_compile(stress_class(n), args.r)
+        if error:
+            print("%6d variables: failed: %s" % (n, error.splitlines()[0]))
+            continue
+        # the time per variable stays flat if compile time grows linearly
+        print("%6d variables: %8.3fs %8.2fus per variable" % (n, elapsed, 1e6 * elapsed / n))
+    exit(0)
+
+if __name__ == '__main__':
+    main()
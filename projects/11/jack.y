@@ -32,38 +32,73 @@
 
  int current_subroutine_parameter_count;
 
+ /* argument counts of the enclosing calls, while parsing a nested call */
+ #define MAX_CALL_DEPTH 256
+ int parameter_count_stack[MAX_CALL_DEPTH];
+ int parameter_count_depth = 0;
+ void push_parameter_count();
+ void pop_parameter_count();
+
  int if_count = 0;
  int while_count = 0;
 
+ /* with -p, each distinct string literal of the class is built once, the
+    first time it is used, and kept in the class's pool: an Array with an
+    element per literal, in the one static variable numbered after those
+    the class declares, and made (zeroed) by a function the compiler adds
+    to the class, Class.$strings, when first needed; so a literal is
+    shared by every use, and must not be changed or disposed of */
+ int pool_strings = 0;
+ int string_count = 0;
+ int pooled_string_index(char *string);
+ void emit_string(char const *string);
+ void emit_string_pool();
+
  struct sym_table_entry {
     char *identifier;
     enum var_extent extent;
     char *type_name;
     int count;
+    int slot; /* its index in the table's slots */
  };
 
- #define MAX_VAR_COUNT 100
-
  typedef struct sym_table_entry sym_table_entry;
- typedef sym_table_entry sym_table[MAX_VAR_COUNT];
+
+ /* entries are kept in declaration order, and found by hashing their
+    identifier into slots (open addressing, probing the next slot on a
+    collision), each of which holds the index of an entry plus one, or 0
+    when free; both arrays double whenever they fill up (the slots at
+    half full), so tables have no size limit */
+ struct sym_table {
+    sym_table_entry *entries;
+    int size;
+    int capacity;
+    int *slots;
+    int slot_count; /* a power of two */
+    int extent_counts[4]; /* entries of each extent */
+ };
+
+ typedef struct sym_table sym_table;
 
  /* we have only two levels of scope in Jack: class-level and subroutine-level. */
  static sym_table class_table;
  static sym_table subroutine_table;
 
- int class_table_size = 0;
- int subroutine_table_size = 0;
+ /* with -p, the string literals of the class, numbered as their extent STATIC */
+ static sym_table string_table;
 
  /* forward declarations */
  int yylex ();
  void yyerror(char const *msg);
 
- int class_table_size_by_extent(sym_table table, const int table_size, enum var_extent extent);
+ int class_table_size_by_extent(sym_table *table, enum var_extent extent);
  char *get_variable_name(char const *name);
  char *get_variable_type(char const *name);
- char *get_variable_name_by_table(char const *name, sym_table table, const int table_size);
- char *get_variable_type_by_table(char const *name, sym_table table, const int table_size);
- void add_var_to_table(char *identifier, sym_table table, int *table_size);
+ char *get_variable_name_by_table(char const *name, sym_table *table);
+ char *get_variable_type_by_table(char const *name, sym_table *table);
+ void add_var_to_table(char *identifier, sym_table *table);
+ sym_table_entry *add_entry(sym_table *table, char *identifier, enum var_extent extent, char *type_name);
+ void clear_table(sym_table *table);
 %}
 
 %union {
@@ -86,7 +121,9 @@
  /* Every Jack file is a single class.
   All class fields and static variables are declared first, followed by subroutines. */
 class:
- K_CLASS className S_LBRACE classVarDecs subroutineDecs S_RBRACE
+ K_CLASS className S_LBRACE classVarDecs subroutineDecs S_RBRACE {
+    emit_string_pool();
+ }
 
 className:
  IDENTIFIER {
@@ -108,8 +145,8 @@ classVarDecType:
  | primitiveType { current_var_type = $1; }
 
 classVarDecNames:
- IDENTIFIER { add_var_to_table($1, class_table, &class_table_size); }
- | classVarDecNames S_COMMA IDENTIFIER { add_var_to_table($3, class_table, &class_table_size); }
+ IDENTIFIER { add_var_to_table($1, &class_table); }
+ | classVarDecNames S_COMMA IDENTIFIER { add_var_to_table($3, &class_table); }
 
 
  /* A single Jack class can have multiple subroutines. These can be constructors, methods (which take an implicit this), or functions. */
@@ -118,7 +155,7 @@ subroutineDecs: /* empty */
 
 subroutineDec:
  subroutineType subroutineReturnType subroutineName S_LPAREN parameterList S_RPAREN subroutineBody {
-      subroutine_table_size = 0;
+      clear_table(&subroutine_table);
  }
 
 subroutineType:
@@ -130,7 +167,7 @@ subroutineType:
     /* For methods, push an implicit 'this' to the stack. */
     current_var_extent = ARG;
     current_var_type = "";
-    add_var_to_table("this", subroutine_table, &subroutine_table_size);
+    add_var_to_table("this", &subroutine_table);
  }
 
 subroutineReturnType:
@@ -165,7 +202,7 @@ parameterType:
 
 parameterName:
  IDENTIFIER {
-    add_var_to_table($1, subroutine_table, &subroutine_table_size);
+    add_var_to_table($1, &subroutine_table);
  }
 
 subroutineBody:
@@ -175,11 +212,11 @@ emitStartCode:
  {
     /* emit function header, based on size of table, as it currently contains all the args */
     printf("function %s.%s %d\n", current_class_name, current_subroutine_name,
-        class_table_size_by_extent(subroutine_table, subroutine_table_size, LOCAL));
+        class_table_size_by_extent(&subroutine_table, LOCAL));
 
     if (current_subroutine_type == CONSTRUCTOR) {
         /* allocate memory for class */
-        printf("push constant %d\n", class_table_size_by_extent(class_table, class_table_size, FIELD));
+        printf("push constant %d\n", class_table_size_by_extent(&class_table, FIELD));
         printf("call Memory.alloc 1\n");
         printf("pop pointer 0\n");
     } else if (current_subroutine_type == METHOD) {
@@ -209,7 +246,7 @@ subroutineVarDecNames:
 
 subroutineVarDecName:
  IDENTIFIER {
-    add_var_to_table($1, subroutine_table, &subroutine_table_size);
+    add_var_to_table($1, &subroutine_table);
  }
 
 
@@ -288,14 +325,17 @@ doStatement:
 subroutineCall:
  subroutineCallNameInsideClass S_LPAREN subroutineCallExpressionList S_RPAREN {
     printf("call %s.%s %d\n" , current_class_name, $1, current_subroutine_parameter_count);
+    pop_parameter_count();
  }
  | subroutineCallClassVarName S_DOT subroutineCallName S_LPAREN subroutineCallExpressionList S_RPAREN {
     printf("call %s.%s %d\n" , $1, $3, current_subroutine_parameter_count);
+    pop_parameter_count();
  }
 
 subroutineCallNameInsideClass:
  IDENTIFIER {
     printf("push pointer 0\n"); /* we're calling a method from inside a class, so push 'this' as an argument */
+    push_parameter_count();
     current_subroutine_parameter_count = 1;
     $$ = $1;
  }
@@ -308,6 +348,7 @@ subroutineCallName:
 subroutineCallClassVarName:
  IDENTIFIER {
     char *var_name;
+    push_parameter_count();
     if ((var_name = get_variable_name($1))) {
         /* if we have a method call, push the object itself to the stack */
         printf("push %s\n", var_name);
@@ -389,13 +430,37 @@ integerConstant:
 
 stringConstant:
  STRING {
-    /* create new string of length equal to length of string */
-    printf("push constant %lu\n", strlen($1));
-    printf("call String.new 1\n");
-    /* for each char in string, call appendChar on new string */
-    for (int i = 0; *($1 + i); i++){
-        printf("push constant %d\n", *($1 + i));
-        printf("call String.appendChar 2\n");
+    if (pool_strings) {
+        /* make the pool on first use only (its static is 0 until then),
+           and likewise the string (its element is 0 until then); temp 0
+           holds the string, while no call can change it */
+        int pool = class_table_size_by_extent(&class_table, STATIC);
+        int index = pooled_string_index($1);
+        printf("push static %d\n", pool);
+        printf("if-goto STRING_POOL%d\n", string_count);
+        printf("call %s.$strings 0\n", current_class_name);
+        printf("pop temp 0\n");
+        printf("label STRING_POOL%d\n", string_count);
+        printf("push static %d\n", pool);
+        printf("push constant %d\n", index);
+        printf("add\n");
+        printf("pop pointer 1\n");
+        printf("push that 0\n");
+        printf("pop temp 0\n");
+        printf("push temp 0\n");
+        printf("if-goto STRING_READY%d\n", string_count);
+        emit_string($1);
+        printf("pop temp 0\n");
+        printf("push static %d\n", pool);
+        printf("push constant %d\n", index);
+        printf("add\n");
+        printf("pop pointer 1\n");
+        printf("push temp 0\n");
+        printf("pop that 0\n");
+        printf("label STRING_READY%d\n", string_count++);
+        printf("push temp 0\n");
+    } else {
+        emit_string($1);
     }
     /* address of string will be top of stack at this point */
  }
@@ -469,106 +534,233 @@ char *get_variable_name(char const *name) {
     /* find variable in table, output its VM-level reference or return null pointer for undefined var */
     char *ret;
 
-    if ((ret = get_variable_name_by_table(name, subroutine_table, subroutine_table_size))) return ret;
-    if ((ret = get_variable_name_by_table(name, class_table, class_table_size))) return ret;
+    if ((ret = get_variable_name_by_table(name, &subroutine_table))) return ret;
+    if ((ret = get_variable_name_by_table(name, &class_table))) return ret;
 
     return 0;
 }
 
-char *get_variable_name_by_table(char const *identifier, sym_table table, const int table_size) {
-    sym_table_entry *curr_entry;
+unsigned int hash_identifier(char const *identifier) {
+    /* FNV-1a */
+    unsigned int hash = 2166136261u;
 
-    static char ret[13];
-    ret[0] = 0;
-
-    char num[4] = {0};
-
-    for (int i = 0; i < table_size; i++){
-        curr_entry = &table[i];
-        if (strcmp(curr_entry->identifier, identifier) == 0){
-            switch (curr_entry->extent) {
-                case STATIC: strcat(ret, "static"); break;
-                case FIELD: strcat(ret, "this"); break;
-                case ARG: strcat(ret, "argument"); break;
-                case LOCAL: strcat(ret, "local"); break;
-            }
-
-            strcat(ret, " ");
-            sprintf(num, "%d", curr_entry->count);
-            strcat(ret, num);
-            return ret;
-        }
+    for (; *identifier; identifier++) {
+        hash = (hash ^ (unsigned char) *identifier) * 16777619u;
     }
 
+    return hash;
+}
 
-    return 0;
+int find_slot(char const *identifier, sym_table *table) {
+    /* return the slot of identifier in table, or the free slot it would go in */
+    int mask = table->slot_count - 1;
+    int slot = hash_identifier(identifier) & mask;
+
+    while (table->slots[slot] &&
+           strcmp(table->entries[table->slots[slot] - 1].identifier, identifier) != 0) {
+        slot = (slot + 1) & mask;
+    }
+
+    return slot;
+}
+
+sym_table_entry *find_in_table(char const *identifier, sym_table *table) {
+    int slot;
+
+    if (table->size == 0) return 0;
+    slot = find_slot(identifier, table);
+
+    return table->slots[slot] ? &table->entries[table->slots[slot] - 1] : 0;
+}
+
+char *get_variable_name_by_table(char const *identifier, sym_table *table) {
+    sym_table_entry *curr_entry;
+
+    static char ret[24];
+    char *segment = "";
+
+    if (!(curr_entry = find_in_table(identifier, table))) return 0;
+
+    switch (curr_entry->extent) {
+        case STATIC: segment = "static"; break;
+        case FIELD: segment = "this"; break;
+        case ARG: segment = "argument"; break;
+        case LOCAL: segment = "local"; break;
+    }
+    sprintf(ret, "%s %d", segment, curr_entry->count);
+
+    return ret;
 }
 
 char *get_variable_type(char const *name) {
     /* find variable in table, output its VM-level reference or return null for undefined var */
     char *ret;
 
-    if ((ret = get_variable_type_by_table(name, subroutine_table, subroutine_table_size))) return ret;
-    if ((ret = get_variable_type_by_table(name, class_table, class_table_size))) return ret;
+    if ((ret = get_variable_type_by_table(name, &subroutine_table))) return ret;
+    if ((ret = get_variable_type_by_table(name, &class_table))) return ret;
 
     return 0;
 }
 
-char *get_variable_type_by_table(char const *identifier, sym_table table, const int table_size) {
+char *get_variable_type_by_table(char const *identifier, sym_table *table) {
     sym_table_entry *curr_entry;
 
-    for (int i = 0; i < table_size; i++){
-        curr_entry = &table[i];
-        if (strcmp(curr_entry->identifier, identifier) == 0){
-            return curr_entry->type_name;
-        }
-    }
+    if (!(curr_entry = find_in_table(identifier, table))) return 0;
 
-    return 0;
+    return curr_entry->type_name;
 }
 
-int class_table_size_by_extent(sym_table table, const int table_size, enum var_extent extent) {
-    int size = 0;
-    sym_table_entry *curr_entry;
+int class_table_size_by_extent(sym_table *table, enum var_extent extent) {
+    return table->extent_counts[extent];
+}
 
-    for(int i = 0; i < table_size; i++) {
-        curr_entry = &table[i];
-        if (curr_entry->extent == extent) size++;
+void *grow(void *array, int count, size_t size) {
+    if (!(array = realloc(array, count * size))) {
+        yyerror("Out of memory!\n");
+        exit(1);
     }
 
-    return size;
+    return array;
 }
 
-void add_var_to_table(char *identifier, sym_table table, int *table_size) {
-    int count = 0;
-    sym_table_entry *curr_entry;
+void grow_slots(sym_table *table) {
+    /* double the slots, and hash every entry again */
+    table->slot_count = table->slot_count ? 2 * table->slot_count : 64;
+    free(table->slots);
+    table->slots = grow(0, table->slot_count, sizeof(int));
+    memset(table->slots, 0, table->slot_count * sizeof(int));
+
+    for (int i = 0; i < table->size; i++) {
+        int slot = find_slot(table->entries[i].identifier, table);
+        table->slots[slot] = i + 1;
+        table->entries[i].slot = slot;
+    }
+}
 
-    for (int i = 0; i < *table_size; i++) {
-        curr_entry = &table[i];
-        if (strcmp(curr_entry->identifier, identifier) == 0) {
-            yyerror("Name already used...\n");
-            return;
-        }
-        if (curr_entry->extent == current_var_extent) {
-            count++;
-        }
+void add_var_to_table(char *identifier, sym_table *table) {
+    if (!add_entry(table, identifier, current_var_extent, current_var_type)) {
+        yyerror("Name already used...\n");
+    }
+}
+
+sym_table_entry *add_entry(sym_table *table, char *identifier, enum var_extent extent, char *type_name) {
+    /* add identifier to table, numbered after the entries of the same extent; return 0 if already there */
+    int slot;
+
+    if (2 * (table->size + 1) > table->slot_count) {
+        grow_slots(table);
+    }
+    slot = find_slot(identifier, table);
+    if (table->slots[slot]) {
+        return 0;
     }
 
-    table[*table_size] = (sym_table_entry) {
+    if (table->size == table->capacity) {
+        table->capacity = table->capacity ? 2 * table->capacity : 32;
+        table->entries = grow(table->entries, table->capacity, sizeof(sym_table_entry));
+    }
+
+    table->entries[table->size] = (sym_table_entry) {
        identifier,
-       current_var_extent,
-       current_var_type,
-       count
+       extent,
+       type_name,
+       table->extent_counts[extent]++,
+       slot
     };
 
-   (*table_size)++;
+   table->slots[slot] = ++table->size;
+   return &table->entries[table->size - 1];
+}
+
+void clear_table(sym_table *table) {
+    /* free only the slots in use, so clearing takes as long as the table has entries */
+    for (int i = 0; i < table->size; i++) {
+        table->slots[table->entries[i].slot] = 0;
+    }
+    table->size = 0;
+    memset(table->extent_counts, 0, sizeof(table->extent_counts));
+}
+
+void emit_string(char const *string) {
+    /* create new string of length equal to length of string */
+    printf("push constant %lu\n", strlen(string));
+    printf("call String.new 1\n");
+    /* for each char in string, call appendChar on new string */
+    for (int i = 0; *(string + i); i++){
+        printf("push constant %d\n", *(string + i));
+        printf("call String.appendChar 2\n");
+    }
+}
+
+int pooled_string_index(char *string) {
+    /* find the literal in the pool, adding it if new, and return its index in the pool */
+    sym_table_entry *entry;
+
+    if (!(entry = find_in_table(string, &string_table))) {
+        entry = add_entry(&string_table, string, STATIC, "String");
+    }
+
+    return entry->count;
+}
+
+void emit_string_pool() {
+    /* add Class.$strings, which makes the pool, with every element 0 */
+    int pool = class_table_size_by_extent(&class_table, STATIC);
+    int size = class_table_size_by_extent(&string_table, STATIC);
+
+    if (size == 0) return;
+    printf("function %s.$strings 1\n", current_class_name);
+    printf("push constant %d\n", size);
+    printf("call Array.new 1\n");
+    printf("pop static %d\n", pool);
+    printf("label STRING_POOL_CLEAR\n");
+    printf("push local 0\n");
+    printf("push constant %d\n", size);
+    printf("lt\n");
+    printf("not\n");
+    printf("if-goto STRING_POOL_CLEARED\n");
+    printf("push static %d\n", pool);
+    printf("push local 0\n");
+    printf("add\n");
+    printf("pop pointer 1\n");
+    printf("push constant 0\n");
+    printf("pop that 0\n");
+    printf("push local 0\n");
+    printf("push constant 1\n");
+    printf("add\n");
+    printf("pop local 0\n");
+    printf("goto STRING_POOL_CLEAR\n");
+    printf("label STRING_POOL_CLEARED\n");
+    printf("push constant 0\n");
+    printf("return\n");
+}
+
+void push_parameter_count() {
+    if (parameter_count_depth == MAX_CALL_DEPTH) {
+        yyerror("Subroutine calls nested too deeply!\n");
+        exit(1);
+    }
+    parameter_count_stack[parameter_count_depth++] = current_subroutine_parameter_count;
+}
+
+void pop_parameter_count() {
+    current_subroutine_parameter_count = parameter_count_stack[--parameter_count_depth];
 }
 
 void yyerror(char const *msg){
     fprintf(stderr, "ERROR! %s\n", msg);
 }
 
-int main() {
+int main(int argc, char **argv) {
+    for (int i = 1; i < argc; i++) {
+        if (strcmp(argv[i], "-p") == 0) {
+            pool_strings = 1;
+        } else {
+            fprintf(stderr, "usage: %s [-p] <Class.jack >Class.vm\n", argv[0]);
+            return 1;
+        }
+    }
+
     yyparse();
 
     return 0;
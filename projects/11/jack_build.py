@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# builds Jack programs all the way down to Hack machine code:
+#   .jack -> .vm     the lex/yacc compiler, one process per file, in parallel
+#   .vm   -> .asm    vm_compiler.compile, over the whole program
+#   .asm  -> .hack   the assembler
+#
+# The compiler itself is first built from jack.l and jack.y, as the
+# Makefile does, into .jackbuild/compiler, when that is missing, older than
+# either, or cannot run on this host. The checked-in binary (built for
+# macOS) is left alone: only make rebuilds it.
+#
+# Every output is stamped, in a .jackbuild directory next to it, with a
+# hash of everything it was built from: its input files, the tool that
+# built it (the compiler binary, or the Python source of the translator or
+# assembler) and the build options, the compiler's too. Outputs whose stamp still matches are
+# not built again, so changing one class only recompiles that class.
+#
+# Several targets are translated and assembled in parallel processes.
+import os
+import sys
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_here, "..", "08"))
+sys.path.insert(0, os.path.join(_here, "..", "06"))
+import vm_compiler
+import vm_optimizer
+import peephole
+import assembler_regex
+import hackbin
+
+COMPILER = os.path.join(_here, ".jackbuild", "compiler")
+OS_DIR = os.path.normpath(os.path.join(_here, "..", "12"))
+
+# the options of vm_compiler.compile a build may set
+_translate_options = ("optimize", "sharedCalls", "sharedCompares", "fold", "inline", "prune",
+                      "cacheTop")
+
+
+def _tool(variable, *candidates):
+    """Returns the command line of a build tool: the environment variable
+    named variable if set (as with make), else the first of candidates
+    found on the PATH."""
+    if os.environ.get(variable):
+        return shlex.split(os.environ[variable])
+    for candidate in candidates:
+        argv = candidate.split()
+        if shutil.which(argv[0]):
+            return argv
+    raise RuntimeError("none of %s found; set %s" % (", ".join(candidates), variable))
+
+
+def _runnable(program):
+    try:
+        subprocess.run([program], stdin=subprocess.DEVNULL, capture_output=True)
+    except OSError:
+        return False
+    return True
+
+
+def build_compiler(force=False, loghook=None):
+    """Rebuilds COMPILER from jack.l and jack.y if needed (or forced).
+    Returns whether it was rebuilt."""
+    sources = [os.path.join(_here, "jack.l"), os.path.join(_here, "jack.y")]
+    if (not force and os.path.exists(COMPILER) and
+            os.path.getmtime(COMPILER) >= max(os.path.getmtime(file) for file in sources) and
+            _runnable(COMPILER)):
+        return False
+    lex = _tool("LEX", "flex", "lex")
+    yacc = _tool("YACC", "yacc", "bison -y")
+    cc = _tool("CC", "gcc", "cc")
+    # generated files go to a scratch directory, so concurrent builds never mix them
+    with tempfile.TemporaryDirectory() as work:
+        for argv in (lex + [sources[0]], yacc + ["-d", sources[1]],
+                     cc + ["lex.yy.c", "y.tab.c", "-o", "compiler"]):
+            if loghook: loghook(" ".join(argv))
+            try:
+                result = subprocess.run(argv, cwd=work, capture_output=True, text=True)
+            except OSError as err:
+                raise RuntimeError("%s: %s" % (argv[0], err.strerror))
+            if result.returncode != 0:
+                raise RuntimeError("%s failed:\n%s" % (argv[0], result.stderr.strip()))
+        os.makedirs(os.path.dirname(COMPILER), exist_ok=True)
+        os.replace(os.path.join(work, "compiler"), COMPILER)
+    return True
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _read(file):
+    with open(file, 'rb') as f:
+        return f.read()
+
+
+def _source_digest(*modules):
+    """Hashes the source of modules, so outputs are rebuilt whenever the
+    code that built them changes."""
+    return _digest(*[_read(module.__file__) for module in modules])
+
+
+def _stamp_file(output):
+    return os.path.join(os.path.dirname(output), ".jackbuild", os.path.basename(output))
+
+
+def _up_to_date(output, digest, force=False):
+    if force or not os.path.exists(output):
+        return False
+    try:
+        with open(_stamp_file(output), 'r') as f:
+            return f.read() == digest
+    except OSError:
+        return False
+
+
+def _stamp(output, digest):
+    stamp = _stamp_file(output)
+    os.makedirs(os.path.dirname(stamp), exist_ok=True)
+    tmp = "%s.%d.tmp" % (stamp, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(digest)
+    os.replace(tmp, stamp)
+
+
+def _compile_jack(source, output, compiler, flags=()):
+    """Compiles a single .jack file, returning an error message, or None."""
+    tmp = "%s.%d.tmp" % (output, os.getpid())
+    with open(source, 'rb') as f, open(tmp, 'wb') as out:
+        result = subprocess.run([compiler, *flags], stdin=f, stdout=out, stderr=subprocess.PIPE)
+    errors = result.stderr.decode(errors="replace").strip()
+    if result.returncode != 0 or errors:
+        os.remove(tmp)
+        return "%s: %s" % (source, errors or "compiler exited with %d" % result.returncode)
+    os.replace(tmp, output)
+    return None
+
+
+def jack_sources(target, with_os=False):
+    """Returns the (.jack file, .vm file) pairs of target, a .jack file or a
+    directory of them. With with_os set, the OS classes of project 12 are
+    compiled into the directory too, except those the directory defines."""
+    if not os.path.isdir(target):
+        return [(target, os.path.splitext(target)[0] + ".vm")]
+    pairs = {}
+    sources = [target, OS_DIR] if with_os else [target]
+    for directory in reversed(sources):  # the target's own classes win
+        for file in os.listdir(directory):
+            if os.path.splitext(file)[1] == ".jack":
+                pairs[file] = (os.path.join(directory, file),
+                               os.path.join(target, os.path.splitext(file)[0] + ".vm"))
+    return [pairs[file] for file in sorted(pairs)]
+
+
+def compile_all(pairs, jobs=1, loghook=None, force=False, pool=False):
+    """Compiles the (.jack file, .vm file) pairs whose output is out of date
+    (or all of them, if force is set), running up to jobs compiler
+    processes at once. With pool set, each string literal is built only
+    once, and shared by every use (the compiler's -p). Returns the number
+    compiled, and raises RuntimeError with every error if any failed."""
+    compiler = _read(COMPILER)
+    flags = ["-p"] if pool else []
+    stale = []
+    for source, output in pairs:
+        digest = _digest(compiler, repr(flags), _read(source))
+        if not _up_to_date(output, digest, force):
+            stale.append((source, output, digest))
+    # every job is a compiler process, so threads are enough to keep jobs busy
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(lambda job: _compile_jack(job[0], job[1], COMPILER, flags), stale))
+    errors = []
+    for (source, output, digest), err in zip(stale, results):
+        if err:
+            errors.append(err)
+            continue
+        _stamp(output, digest)
+        if loghook: loghook("compiled %s" % source)
+    if errors:
+        raise RuntimeError("%d of %d files failed:\n%s" % (len(errors), len(stale), "\n".join(errors)))
+    return len(stale)
+
+
+def link(target, cache=False, binary=False, source_map=False, loghook=None, force=False,
+         **options):
+    """Translates the .vm files of target (a directory, or the .vm file of a
+    single .jack file) with vm_compiler and assembles the result, each only
+    if its inputs changed, or force is set. options are passed on to
+    vm_compiler.compile. Bootstrap code is added when the program has a
+    Sys class."""
+    if os.path.isdir(target):
+        target = os.path.normpath(target)
+        files = sorted(os.path.join(target, file) for file in os.listdir(target)
+                       if os.path.splitext(file)[1] == ".vm")
+        asm = os.path.join(target, os.path.basename(os.path.abspath(target)) + ".asm")
+    else:
+        target = os.path.splitext(target)[0] + ".vm"
+        files = [target]
+        asm = os.path.splitext(target)[0] + ".asm"
+    bootstrap = any(os.path.basename(file) == "Sys.vm" for file in files)
+    options = {name: options.get(name, False) for name in _translate_options}
+    digest = _digest(_source_digest(vm_compiler, vm_optimizer, peephole),
+                     repr((bootstrap, source_map, sorted(options.items()))),
+                     *[part for file in files for part in (os.path.basename(file), _read(file))])
+    if _up_to_date(asm, digest, force):
+        if loghook: loghook("%s is up to date" % asm)
+    else:
+        writer = vm_compiler.compile(target, bootstrap, cache, sourceMap=source_map, **options)
+        _stamp(asm, digest)
+        if loghook: loghook("translated %s (%d ROM words)" % (asm, writer.romWords))
+    out = os.path.splitext(asm)[0] + (".hackbin" if binary else ".hack")
+    digest = _digest(_source_digest(assembler_regex, hackbin), repr((binary, source_map)), _read(asm))
+    if _up_to_date(out, digest, force):
+        if loghook: loghook("%s is up to date" % out)
+    else:
+        assembler_regex.assemble(asm, out, binary=binary, source_map=source_map)
+        _stamp(out, digest)
+        if loghook: loghook("assembled %s" % out)
+    return out
+
+
+def _link_job(target, options):
+    """Links a single target for build, returning its log and its error
+    message (None on success) instead of writing to stderr."""
+    log = []
+    try:
+        link(target, loghook=log.append, **options)
+    except (RuntimeError, OSError) as err:
+        return log, "%s: %s" % (target, err.args[-1])
+    return log, None
+
+
+def build(targets, jobs=1, with_os=False, loghook=None, force=False, pool=False, **options):
+    """Builds each of targets (.jack files, or directories of them) down to
+    Hack machine code: rebuilds the compiler if needed, compiles every
+    changed .jack file in up to jobs parallel processes (see compile_all
+    for pool), then translates and assembles each target, up to jobs at a
+    time (see link for the options). With force set, everything is
+    rebuilt, the compiler too. Raises RuntimeError listing every error."""
+    build_compiler(force, loghook)
+    pairs = [pair for target in targets for pair in jack_sources(target, with_os)]
+    compile_all(pairs, jobs, loghook, force, pool)
+    options["force"] = force
+    if jobs > 1 and len(targets) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_link_job, targets, [options] * len(targets)))
+    else:
+        results = [_link_job(target, options) for target in targets]
+    errors = []
+    for log, err in results:
+        if loghook:
+            for line in log: loghook(line)
+        if err: errors.append(err)
+    if errors:
+        raise RuntimeError("\n".join(errors))
+
+
+def main():
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description='Builds Jack programs into Hack machine code')
+    parser.add_argument("targets", nargs="+", help=".jack files, or directories of them")
+    parser.add_argument("-l", help="Compile the OS (project 12) into each directory too",
+                        action="store_true")
+    parser.add_argument("-j", help="Run N jobs in parallel (default: one per core)", metavar="N",
+                        type=int, default=os.cpu_count() or 1)
+    parser.add_argument("-f", help="Rebuild the compiler and everything else", action="store_true")
+    parser.add_argument("-p", help="Build each string literal once, and share it", action="store_true")
+    parser.add_argument("-c", help="Cache translated .vm files (see vm_compiler)", action="store_true")
+    parser.add_argument("-B", help="Write packed binary (.hackbin) output", action="store_true")
+    parser.add_argument("-m", help="Write a source map (.hackmap)", action="store_true")
+    parser.add_argument("-O", help="Run the peephole optimizer", action="store_true")
+    parser.add_argument("-s", help="Share one copy of the call and return code", action="store_true")
+    parser.add_argument("-e", help="Share one copy of each comparison (eq, lt, gt)", action="store_true")
+    parser.add_argument("-F", help="Fold constants and multiplications by constants",
+                        action="store_true")
+    parser.add_argument("-i", help="Inline calls to small leaf functions", action="store_true")
+    parser.add_argument("-D", help="Leave out functions never called from Sys.init", action="store_true")
+    parser.add_argument("-T", help="Keep the top of the stack in D between commands", action="store_true")
+    args = parser.parse_args()
+    log = lambda line: print(line, file=sys.stderr)
+    start = perf_counter()
+    try:
+        build(args.targets, args.j, args.l, log, args.f, args.p, cache=args.c, binary=args.B,
+              source_map=args.m, optimize=args.O, sharedCalls=args.s, sharedCompares=args.e, fold=args.F,
+              inline=args.i, prune=args.D, cacheTop=args.T)
+    except (RuntimeError, OSError) as err:
+        print(err.args[-1], file=sys.stderr)
+        exit(1)
+    print("built in %0.3fs" % (perf_counter() - start), file=sys.stderr)
+    exit(0)
+
+if __name__ == '__main__':
+    main()
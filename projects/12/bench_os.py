@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# runs the OS benchmark programs in bench/ on the Hack emulator, with this
+# OS, and reports the cycles the OS functions each exercises take, per call
+# or per unit of work (such as a pixel) counted by the program itself
+import os
+import sys
+import argparse
+import tempfile
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_here, "..", "11"))
+import jack_build
+import vm_profiler
+
+BENCH_DIR = os.path.join(_here, "bench")
+
+# benchmark -> the functions to report by default, each with the RAM
+# address where the program leaves the units of work it did, and their
+# name, or None to report cycles per call
+_focus = {
+    "MathBench": [("Math.multiply", None), ("Math.divide", None), ("Math.sqrt", None)],
+    "MemoryBench": [("Memory.alloc", None), ("Memory.deAlloc", None)],
+    "StringBench": [("String.new", None), ("String.appendChar", None), ("Output.printString", None)],
+    "TextBench": [("Output.printString", 8000, "character"), ("Output.printInt", 8001, "character"),
+                  ("Output.printChar", None)],
+    "ScreenBench": [("Screen.drawRectangle", 8000, "pixel"), ("Screen.drawLine", 8001, "pixel"),
+                    ("Screen.drawCircle", 8002, "pixel")],
+}
+
+
+def measure(program, cycles=None, pool=False, **options):
+    """Compiles program (a directory of .jack files) with the OS, sharing
+    string literals if pool is set (see jack_build.compile_all), builds it
+    with the options given to vm_profiler.build and runs it up to Sys.halt,
+    or for about cycles cycles. Returns the Profiler, and whether the
+    program got to Sys.halt.
+    Everything is built in a temporary directory, so nothing is written
+    to the program's directory.
+    The whole OS does not fit in ROM, so the functions the program never
+    calls are always left out; even so, some programs only fit with -T
+    or -s (see vm_compiler)."""
+    jack_build.build_compiler()
+    with tempfile.TemporaryDirectory() as work:
+        pairs = [(source, os.path.join(work, os.path.basename(output)))
+                 for source, output in jack_build.jack_sources(program, True)]
+        jack_build.compile_all(pairs, os.cpu_count() or 1, pool=pool)
+        words, marks, sym = vm_profiler.build(work, True, prune=True, **options)
+    if len(words) > 32768:
+        raise RuntimeError("%s: %d words do not fit in ROM" % (program, len(words)))
+    profiler = vm_profiler.Profiler(words, marks)
+    profiler.run(cycles, sym.get("Sys.halt"))
+    return profiler, profiler.machine.pc == sym.get("Sys.halt")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the OS benchmarks on the Hack emulator')
+    parser.add_argument("programs", nargs="*",
+                        help="benchmark directories (default: every one in bench/)")
+    parser.add_argument("-f", help="Report the cycles per call of this function too",
+                        metavar="FUNCTION", action="append", default=[])
+    parser.add_argument("-n", help="Stop after about N cycles", metavar="N", type=int)
+    parser.add_argument("-p", help="Build each string literal once, and share it", action="store_true")
+    parser.add_argument("-O", help="Run the peephole optimizer", action="store_true")
+    parser.add_argument("-s", help="Share one copy of the call and return code", action="store_true")
+    parser.add_argument("-e", help="Share one copy of each comparison (eq, lt, gt)", action="store_true")
+    parser.add_argument("-F", help="Fold constants and multiplications by constants",
+                        action="store_true")
+    parser.add_argument("-i", help="Inline calls to small leaf functions", action="store_true")
+    parser.add_argument("-T", help="Keep the top of the stack in D between commands", action="store_true")
+    args = parser.parse_args()
+    programs = args.programs or sorted(os.path.join(BENCH_DIR, name) for name in os.listdir(BENCH_DIR)
+                                       if os.path.isdir(os.path.join(BENCH_DIR, name)))
+    try:
+        for program in programs:
+            profile, halted = measure(program, args.n, args.p, optimize=args.O, sharedCalls=args.s,
+                              sharedCompares=args.e, fold=args.F, inline=args.i, cacheTop=args.T)
+            name = os.path.basename(os.path.normpath(program))
+            machine = profile.machine
+            if profile.calls.get("Sys.error"):
+                status = "failed with Sys.error"
+            else:
+                status = "halted" if halted else "stopped"
+            print("%s: %d cycles, %s; RAM[8000..8003] = %s" %
+                  (name, machine.cycles, status, list(machine.ram[8000:8004])))
+            inclusive = profile.inclusive()
+            for function, *units in _focus.get(name, []) + [(function, None) for function in args.f]:
+                calls = profile.calls.get(function, 0)
+                if not calls:
+                    continue
+                if units[0] is None:
+                    print("  %-24s %8d calls %10.1f cycles per call" %
+                          (function, calls, inclusive[function] / calls))
+                else:
+                    address, unit = units
+                    count = machine.ram[address]
+                    print("  %-24s %8d calls %10.1f cycles per %s (%d %ss)" %
+                          (function, calls, inclusive[function] / max(count, 1), unit, count, unit))
+    except RuntimeError as err:
+        print(err.args[0], file=sys.stderr)
+        exit(1)
+    exit(0)
+
+if __name__ == '__main__':
+    main()